@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+""" This script measures throughput and latency of the books service.
+
+    For every catalogue size and concurrency level the catalogue is
+    filled up to the size, and then `--concurrency` clients send
+    requests for `--duration` seconds. Every client picks operations
+    at random with weights from `--mix`:
+
+        login             GET /login
+        add_book          POST /add_book
+        list              GET /books
+        list_sorted       GET /books?sort=by_title
+        list_limit        GET /books?limit=<--page-size>
+        list_sorted_limit GET /books?sort=by_title&limit=<--page-size>
+        get               GET /books/<id>
+        update            PUT /books/<id>
+        delete            DELETE /books/<id> (of a book added by the
+                          benchmark, the book is added before the
+                          request and is not measured)
+
+    Throughput and p50/p95/p99 latency of every operation are printed
+    and saved to `--output` as JSON. With `--compare` the results are
+    compared with results of the previous run, and the script exits
+    with code 1 if throughput fell or p95 latency grew by more than
+    `--threshold` percent.
+
+    Example:
+        python bench.py --catalogue 1000,10000 --concurrency 1,8 \\
+            --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+log = logging.getLogger('books_service.bench')
+
+DEFAULT_MIX = ('login=1,add_book=2,list=1,list_sorted=1,list_limit=4,'
+               'list_sorted_limit=4,get=10,update=3,delete=1')
+
+
+class Worker(threading.Thread):
+    """ This class is one client of the service which sends requests
+        until the deadline and keeps latency of every request.
+    """
+
+    def __init__(self, bench, seed, deadline):
+        super().__init__(daemon=True)
+        self.bench = bench
+        self.deadline = deadline
+        self.random = random.Random(seed)
+
+        # operation -> list of latencies in seconds:
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=1))
+
+    def run(self):
+        self.cookies = self.bench.login(self.session)
+        ops, weights = zip(*self.bench.mix.items())
+
+        while time.monotonic() < self.deadline:
+            op = self.random.choices(ops, weights)[0]
+            send = getattr(self, 'op_' + op)
+
+            # Broken body of the response is an error too, so the
+            # worker does not stop before the deadline:
+            try:
+                elapsed, ok = send()
+            except (requests.RequestException, ValueError):
+                elapsed, ok = None, False
+
+            if ok:
+                self.latencies[op].append(elapsed)
+            else:
+                self.errors[op] += 1
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('cookies', self.cookies)
+        kwargs.setdefault('timeout', self.bench.args.timeout)
+
+        started = time.perf_counter()
+        response = self.session.request(method, self.bench.url + path,
+                                        **kwargs)
+        # The body is read completely before the time is taken:
+        response.content
+        elapsed = time.perf_counter() - started
+
+        return elapsed, response
+
+    def op_login(self):
+        elapsed, response = self.request('GET', '/login', cookies=None,
+                                         auth=self.bench.auth)
+        return elapsed, response.status_code == 200
+
+    def op_add_book(self):
+        elapsed, response = self.request('POST', '/add_book',
+                                         data=self.bench.new_book())
+        if response.status_code == 200:
+            self.bench.added(response.json()['id'])
+
+        return elapsed, response.status_code == 200
+
+    def op_list(self):
+        return self.list_books({})
+
+    def op_list_sorted(self):
+        return self.list_books({'sort': 'by_title'})
+
+    def op_list_limit(self):
+        return self.list_books({'limit': self.bench.args.page_size})
+
+    def op_list_sorted_limit(self):
+        return self.list_books({'sort': 'by_title',
+                                'limit': self.bench.args.page_size})
+
+    def list_books(self, params):
+        elapsed, response = self.request('GET', '/books', params=params)
+        return elapsed, response.status_code == 200
+
+    def op_get(self):
+        book_id = self.random.choice(self.bench.book_ids)
+        elapsed, response = self.request('GET', '/books/' + book_id)
+        return elapsed, response.status_code == 200
+
+    def op_update(self):
+        book_id = self.random.choice(self.bench.book_ids)
+        elapsed, response = self.request('PUT', '/books/' + book_id,
+                                         data=self.bench.new_book())
+        return elapsed, response.status_code == 200
+
+    def op_delete(self):
+        book_id = self.bench.take_added()
+
+        if book_id is None:
+            _, response = self.request('POST', '/add_book',
+                                       data=self.bench.new_book())
+            # The book was not added, e.g. the service is overloaded:
+            if response.status_code != 200:
+                return None, False
+
+            book_id = response.json()['id']
+
+        elapsed, response = self.request('DELETE', '/books/' + book_id)
+        return elapsed, response.status_code == 200
+
+
+class Benchmark(object):
+    """ This class runs the benchmark for all catalogue sizes
+        and concurrency levels.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.url = args.url.rstrip('/')
+        self.auth = (args.user, args.password)
+        self.mix = parse_mix(args.mix)
+        self.random = random.Random(args.seed)
+
+        # Books of the catalogue for get and update:
+        self.book_ids = []
+        # Books added by the benchmark, they can be deleted:
+        self._added = []
+        self._lock = threading.Lock()
+
+    def login(self, session):
+        response = session.get(self.url + '/login', auth=self.auth,
+                               timeout=self.args.timeout)
+        response.raise_for_status()
+
+        return {'my_cookie': response.json()['auth_cookie']}
+
+    def new_book(self):
+        with self._lock:
+            title = 'Book {0}'.format(self.random.randrange(10 ** 9))
+
+        return {'title': title, 'author': 'Benchmark'}
+
+    def added(self, book_id):
+        with self._lock:
+            self._added.append(book_id)
+
+    def take_added(self):
+        with self._lock:
+            return self._added.pop() if self._added else None
+
+    def fill_catalogue(self, size):
+        """ This function adds books until the catalogue has
+            at least `size` books. Books are never removed, so sizes
+            must go up.
+        """
+
+        session = requests.Session()
+        cookies = self.login(session)
+
+        response = session.get(self.url + '/books', cookies=cookies,
+                               params={'fields': 'id'},
+                               timeout=self.args.timeout)
+        response.raise_for_status()
+        self.book_ids = [book['id'] for book in response.json()]
+
+        while len(self.book_ids) < size:
+            count = min(size - len(self.book_ids), 1000)
+            books = [self.new_book() for _ in range(count)]
+
+            response = session.post(self.url + '/add_books', json=books,
+                                    cookies=cookies,
+                                    timeout=self.args.timeout)
+            response.raise_for_status()
+            self.book_ids.extend(book['id'] for book in response.json())
+
+        if len(self.book_ids) > size:
+            log.warning('Catalogue has %s books, more than %s',
+                        len(self.book_ids), size)
+        else:
+            log.info('Catalogue has %s books', len(self.book_ids))
+
+    def run_level(self, concurrency):
+        """ This function runs clients for one concurrency level
+            and returns statistics of the operations.
+        """
+
+        deadline = time.monotonic() + self.args.duration
+        workers = [Worker(self, self.args.seed + i, deadline)
+                   for i in range(concurrency)]
+
+        started = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - started
+
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        for worker in workers:
+            for op, values in worker.latencies.items():
+                latencies[op].extend(values)
+            for op, count in worker.errors.items():
+                errors[op] += count
+
+        ops = {op: summarize(latencies[op], errors[op], elapsed)
+               for op in sorted(set(latencies) | set(errors))}
+        total = summarize([value for values in latencies.values()
+                           for value in values],
+                          sum(errors.values()), elapsed)
+
+        return {'ops': ops, 'total': total}
+
+    def run(self):
+        results = []
+
+        for size in self.args.catalogue:
+            self.fill_catalogue(size)
+
+            for concurrency in self.args.concurrency:
+                log.info('Running %s clients for %s seconds',
+                         concurrency, self.args.duration)
+                level = self.run_level(concurrency)
+                level.update(catalogue=size, concurrency=concurrency)
+                results.append(level)
+
+        return results
+
+
+def percentile(values, percent):
+    """ This function returns percentile of sorted values
+        by the nearest rank method.
+    """
+
+    if not values:
+        return None
+
+    rank = max(math.ceil(percent / 100.0 * len(values)) - 1, 0)
+
+    return values[rank]
+
+
+def summarize(latencies, errors, elapsed):
+    """ This function returns throughput and latency (in ms)
+        of one operation.
+    """
+
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {'count': len(latencies),
+            'errors': errors,
+            'throughput': round(len(latencies) / elapsed, 2),
+            'mean': ms(sum(latencies) / len(latencies)
+                       if latencies else None),
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99))}
+
+
+def parse_mix(mix):
+    """ This function parses 'op=weight,...' string. """
+
+    weights = {}
+
+    for item in mix.split(','):
+        op, _, weight = item.partition('=')
+        op = op.strip()
+
+        if not hasattr(Worker, 'op_' + op):
+            raise argparse.ArgumentTypeError('Unknown operation: ' + op)
+
+        weights[op] = float(weight or 1)
+
+    return {op: weight for op, weight in weights.items() if weight > 0}
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def print_results(results):
+    row = '{0:>9} {1:>5} {2:<18} {3:>7} {4:>6} {5:>10} {6:>9} {7:>9} {8:>9}'
+    print(row.format('catalogue', 'conc', 'operation', 'count', 'errors',
+                     'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+
+    for level in results:
+        ops = sorted(level['ops'].items()) + [('TOTAL', level['total'])]
+
+        for op, stats in ops:
+            print(row.format(level['catalogue'], level['concurrency'], op,
+                             stats['count'], stats['errors'],
+                             stats['throughput'], str(stats['p50']),
+                             str(stats['p95']), str(stats['p99'])))
+
+
+def compare(results, baseline, threshold):
+    """ This function prints changes against the baseline and returns
+        the list of regressions.
+    """
+
+    old_levels = {(level['catalogue'], level['concurrency']): level
+                  for level in baseline['results']}
+    regressions = []
+
+    for level in results:
+        old_level = old_levels.get((level['catalogue'],
+                                    level['concurrency']))
+        if old_level is None:
+            continue
+
+        ops = dict(level['ops'], TOTAL=level['total'])
+        old_ops = dict(old_level['ops'], TOTAL=old_level['total'])
+
+        for op in sorted(set(ops) & set(old_ops)):
+            new, old = ops[op], old_ops[op]
+            changes = []
+
+            if old['throughput'] and new['throughput'] is not None:
+                change = (new['throughput'] / old['throughput'] - 1) * 100
+                changes.append(('throughput', change, change < -threshold))
+
+            if old['p95'] and new['p95'] is not None:
+                change = (new['p95'] / old['p95'] - 1) * 100
+                changes.append(('p95', change, change > threshold))
+
+            for metric, change, regressed in changes:
+                mark = 'REGRESSION' if regressed else ''
+                print('{0:>9} {1:>5} {2:<18} {3:<10} {4:+8.1f}% {5}'.format(
+                    level['catalogue'], level['concurrency'], op, metric,
+                    change, mark))
+
+                if regressed:
+                    regressions.append((level['catalogue'],
+                                        level['concurrency'], op, metric))
+
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:7000')
+    parser.add_argument('--user', default='test_user')
+    parser.add_argument('--password', default='test_password')
+    parser.add_argument('--catalogue', type=int_list, default=[1000],
+                        help='comma separated sizes of the catalogue, '
+                             'from smaller to larger')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8],
+                        help='comma separated numbers of clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run every concurrency level')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='comma separated operation=weight')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='limit of books for list_limit operations')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='timeout of one request in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to save results as JSON')
+    parser.add_argument('--compare', help='results of previous run')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent of change which is a regression')
+
+    args = parser.parse_args(argv)
+    # The catalogue is only filled up, so the smaller size after
+    # the larger one would be measured on the larger catalogue:
+    if args.catalogue != sorted(set(args.catalogue)):
+        parser.error('Sizes of the catalogue must go up: {0}'.format(
+            ','.join(map(str, args.catalogue))))
+
+    try:
+        parse_mix(args.mix)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(message)s')
+    args = parse_args(argv)
+
+    started = datetime.now(timezone.utc).isoformat()
+    results = Benchmark(args).run()
+    print_results(results)
+
+    report = {'started': started,
+              'args': vars(args),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+""" This module checks user and password of basic auth.
+
+    Passwords in BASIC_AUTH_USERS are kept as PBKDF2 hashes, which
+    are created with:
+        python auth.py <password>
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from flask_basicauth import BasicAuth
+
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = 600000
+
+
+def hash_password(password, iterations=ITERATIONS, salt=None):
+    """ This function returns PBKDF2 hash of the password in format
+        'pbkdf2_sha256$<iterations>$<salt>$<hash>'.
+    """
+
+    salt = salt or base64.b64encode(os.urandom(16)).decode('ascii')
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf8'),
+                                 salt.encode('utf8'), iterations)
+
+    return '{0}${1}${2}${3}'.format(ALGORITHM, iterations, salt,
+                                    base64.b64encode(digest).decode('ascii'))
+
+
+def verify_password(password, encoded):
+    """ This function checks the password against its hash. """
+
+    try:
+        algorithm, iterations, salt, _ = encoded.split('$')
+        iterations = int(iterations)
+    except (AttributeError, ValueError):
+        return False
+
+    if algorithm != ALGORITHM:
+        return False
+
+    return hmac.compare_digest(
+        hash_password(password, iterations, salt).encode('utf8'),
+        encoded.encode('utf8'))
+
+
+class CachedBasicAuth(BasicAuth):
+    """ This class checks user and password of basic auth with
+        `verify()`, and remembers verified credentials for `ttl`
+        seconds, so clients which log in often do not pay for
+        the hash every time.
+
+        Only digests of verified credentials are kept: they are made
+        with HMAC and a random key of the process, so passwords can
+        not be recovered from the cache. No more than `max_size`
+        digests are kept, the oldest ones are evicted first.
+
+        Subclasses may override `verify()` to check credentials
+        in another way.
+    """
+
+    def __init__(self, app=None, ttl=60, max_size=1000,
+                 clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+
+        self._key = os.urandom(32)
+        # digest -> expiration time:
+        self._verified = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        super().__init__(app)
+
+    def check_credentials(self, username, password):
+        """ This function checks credentials with the cache first. """
+
+        digest = self._digest(username, password)
+
+        with self._lock:
+            expires = self._verified.get(digest)
+            if expires is not None and expires > self._clock():
+                self.hits += 1
+                return True
+            self.misses += 1
+
+        if not self.verify(username, password):
+            return False
+
+        with self._lock:
+            self._verified.pop(digest, None)
+            self._verified[digest] = self._clock() + self.ttl
+
+            while len(self._verified) > self.max_size:
+                self._verified.popitem(last=False)
+
+        return True
+
+    def verify(self, username, password):
+        """ This function checks user and password by BASIC_AUTH_USERS
+            (user -> hash of password), or by BASIC_AUTH_USERNAME and
+            BASIC_AUTH_PASSWORD if it is not set.
+        """
+
+        users = current_app.config.get('BASIC_AUTH_USERS')
+
+        if users:
+            encoded = users.get(username)
+            return encoded is not None and verify_password(password, encoded)
+
+        correct_username = current_app.config['BASIC_AUTH_USERNAME']
+        correct_password = current_app.config['BASIC_AUTH_PASSWORD']
+
+        # Both values are compared, so the time does not show
+        # which one is wrong:
+        valid_username = hmac.compare_digest(username.encode('utf8'),
+                                             correct_username.encode('utf8'))
+        valid_password = hmac.compare_digest(password.encode('utf8'),
+                                             correct_password.encode('utf8'))
+
+        return valid_username and valid_password
+
+    def clear(self):
+        """ This function forgets all verified credentials. """
+
+        with self._lock:
+            self._verified.clear()
+
+    def stats(self):
+        """ This function returns counters of the cache. """
+
+        with self._lock:
+            return {'credentials': len(self._verified),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def _digest(self, username, password):
+        # Users and passwords from config are the part of the key,
+        # so credentials are checked again when config is changed:
+        config = current_app.config
+        users = config.get('BASIC_AUTH_USERS') or {}
+        message = '\0'.join((username, password, users.get(username, ''),
+                             config['BASIC_AUTH_USERNAME'],
+                             config['BASIC_AUTH_PASSWORD']))
+
+        return hmac.new(self._key, message.encode('utf8'),
+                        hashlib.sha256).digest()
+
+
+if __name__ == '__main__':
+    print(hash_password(sys.argv[1]))
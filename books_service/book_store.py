@@ -0,0 +1,510 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import bisect
+import heapq
+import itertools
+import sys
+from uuid import uuid4
+
+from locks import ReadWriteLock
+from search_index import SearchIndex
+
+
+# Fields of the book which can be requested with projection:
+FIELDS = ('id', 'title', 'author')
+
+
+def prefix_end(prefix):
+    """ This function returns the smallest string which is greater
+        than all strings starting with prefix, or None if there is
+        no such string.
+    """
+
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SortedIndex(object):
+    """ This class keeps a sorted list of keys, so a slice of the
+        list in sorted order costs as much as the slice itself.
+    """
+
+    # Batches bigger than this are merged into the index with one
+    # pass over the whole list instead of one insert per key:
+    BATCH_THRESHOLD = 16
+
+    def __init__(self):
+        self._keys = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        """ This function inserts new key into the index. """
+
+        bisect.insort(self._keys, key)
+
+    def add_many(self, keys):
+        """ This function inserts several keys into the index. """
+
+        if len(keys) <= self.BATCH_THRESHOLD:
+            for key in keys:
+                self.add(key)
+        else:
+            # Timsort merges already sorted list with sorted tail
+            # in linear time:
+            self._keys.extend(sorted(keys))
+            self._keys.sort()
+
+    def remove(self, key):
+        """ This function removes the key from the index. """
+
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def remove_many(self, keys):
+        """ This function removes several keys from the index. """
+
+        if len(keys) <= self.BATCH_THRESHOLD:
+            for key in keys:
+                self.remove(key)
+        else:
+            keys = set(keys)
+            self._keys = [key for key in self._keys if key not in keys]
+
+    def bounds(self, low, high=None):
+        """ This function returns positions of the first key which is
+            not less than `low` and of the first key which is not less
+            than `high` (the end of the index if high is None).
+        """
+
+        start = bisect.bisect_left(self._keys, low)
+        if high is None:
+            return start, len(self._keys)
+
+        return start, bisect.bisect_left(self._keys, high, start)
+
+    def slice(self, start=0, stop=None):
+        """ This function returns keys from start to stop position. """
+
+        return self._keys[start:stop]
+
+
+class BookStore(object):
+    """ This class keeps all books of the service.
+
+        Books are stored in a dict by id, so lookup, update and delete
+        of one book do not scan the whole catalogue. Python dicts keep
+        insertion order, so the list of books stays in the order in
+        which books were added.
+
+        Every book gets a sequence number when it is added. Two sorted
+        indexes allow to read any page of the catalogue without walking
+        the books before it: one by (seq) for insertion order and one
+        by (title, seq) for sort by title, so books with the same title
+        keep insertion order, exactly like sorted() over the list does.
+
+        Books of one author are found by the index by (author, seq),
+        and books with given title prefix are a range of the index by
+        title. When both filters are given, only the smaller range is
+        read. Filtered books are sorted in memory only when the range
+        does not have the requested order.
+
+        Words of titles and authors are kept in the inverted index
+        (see search_index.SearchIndex) for full text search.
+
+        The store is safe to use from many threads. Reads of several
+        books hold the lock for reading, and changes hold it for
+        writing. Batch changes take the lock once and update the
+        indexes with one pass for the batch.
+
+        Books are never changed in place: update replaces the book
+        with a new dict, so a book returned to a reader stays the same
+        while it is serialized, even if it is updated at the same time.
+
+        Every change of books increases the version of the store.
+        Versions are counted from zero when the store is created, so
+        `epoch` tells different instances of the store apart.
+
+        Optional persistence backend (see persistence.LogBackend) loads
+        the books when the store is created and gets every change as
+        a list of records before the change is applied.
+    """
+
+    def __init__(self, backend=None):
+        self._books = {}
+        self._seqs = {}
+        self._counter = itertools.count()
+        self._by_seq = SortedIndex()
+        self._by_title = SortedIndex()
+        self._by_author = SortedIndex()
+        self._search = SearchIndex()
+        self._lock = ReadWriteLock()
+        self._version = 0
+        self.epoch = str(uuid4())
+
+        self._backend = backend
+        self._snapshot_due = False
+
+        if backend is not None:
+            with self._lock.write():
+                self._insert(backend.load())
+
+    def __len__(self):
+        return len(self._books)
+
+    def __contains__(self, book_id):
+        return book_id in self._books
+
+    def all(self):
+        """ This function returns the list of books in insertion order. """
+
+        with self._lock.read():
+            return list(self._books.values())
+
+    def page(self, sort=None, start=0, limit=None, author=None,
+             title_prefix=None, fields=None, after=None):
+        """ This function returns `limit` books starting from position
+            `start` in insertion order or, with sort='by_title',
+            sorted by title. If `after` is (seq, title) of some book,
+            positions are counted from the book next to it, even if
+            that book was deleted.
+
+            Only books of given author and/or with given title prefix
+            are returned if these filters are set, and only given
+            fields of the books if `fields` is set.
+        """
+
+        return self.page_with_keys(sort, start, limit, author,
+                                   title_prefix, fields, after)[0]
+
+    def iter_page(self, sort=None, start=0, limit=None, author=None,
+                  title_prefix=None, fields=None, after=None):
+        """ This function returns the same books as page() one by one.
+            Only references to the books are kept until they are read,
+            and fields are taken from every book when it is read.
+        """
+
+        books = self.page(sort, start, limit, author, title_prefix,
+                          after=after)
+
+        if fields is None:
+            return iter(books)
+
+        return ({field: book[field] for field in fields} for book in books)
+
+    def page_with_keys(self, sort=None, start=0, limit=None, author=None,
+                       title_prefix=None, fields=None, after=None):
+        """ This function returns the same books as page() and the list
+            of (seq, title) of every book. They are read under the same
+            lock, so the cursor to the next page can be created even if
+            the last book of the page is deleted right after that.
+        """
+
+        with self._lock.read():
+            keys = self._filter(sort, author, title_prefix)
+
+            if after is not None:
+                # The key which goes right after all keys of the book:
+                seq, title = after
+                low = (title, seq + 1) if sort == 'by_title' else (seq + 1,)
+
+                if keys is None:
+                    start += self._index(sort).bounds(low)[0]
+                else:
+                    start += bisect.bisect_left(keys, low)
+
+            stop = None if limit is None else start + limit
+
+            if keys is None:
+                keys = self._index(sort).slice(start, stop)
+            else:
+                keys = keys[start:stop]
+
+            books = [self._books[key[-1]] for key in keys]
+
+        # Seq is the one before id in keys of both orders:
+        keys = [(key[-2], book['title']) for key, book in zip(keys, books)]
+
+        if fields is not None:
+            books = [{field: book[field] for field in fields}
+                     for book in books]
+
+        return books, keys
+
+    def search(self, query, start=0, limit=None):
+        """ This function returns `limit` books starting from position
+            `start` in the list of books which have all words of the
+            query, books with the best score go first.
+        """
+
+        stop = None if limit is None else start + limit
+
+        with self._lock.read():
+            scores = self._search.search(query, len(self._books))
+
+            def rank(book_id):
+                return -scores[book_id], self._seqs[book_id]
+
+            if stop is None:
+                found = sorted(scores, key=rank)
+            else:
+                found = heapq.nsmallest(stop, scores, key=rank)
+
+            return [self._books[book_id] for book_id in found[start:]]
+
+    def version(self):
+        """ This function returns current version of the store. """
+
+        return self._version
+
+    def seq(self, book_id):
+        """ This function returns sequence number of the book. """
+
+        return self._seqs.get(book_id)
+
+    def get(self, book_id):
+        """ This function returns one book or None. """
+
+        return self._books.get(book_id)
+
+    def add(self, book):
+        """ This function adds new book to the store. """
+
+        return self.add_many([book])[0]
+
+    def add_many(self, books):
+        """ This function adds several books to the store. """
+
+        with self._lock.write():
+            self._log([{'op': 'add', 'book': book} for book in books])
+            self._insert(books)
+            self._version += 1
+
+        self._snapshot_if_due()
+
+        return books
+
+    def update(self, book_id, title=None, author=None):
+        """ This function updates title and/or author of the book
+            and returns updated book or None if there is no such book.
+        """
+
+        return self.update_many([(book_id, title, author)])[0]
+
+    def update_many(self, changes):
+        """ This function applies several (book_id, title, author)
+            changes and returns the list of updated books, with None
+            for every change of nonexistent book.
+        """
+
+        result = []
+        # book_id -> new version of the book:
+        updated = {}
+
+        with self._lock.write():
+            for book_id, title, author in changes:
+                book = updated.get(book_id) or self._books.get(book_id)
+
+                if book is not None:
+                    book = dict(book)
+                    if title is not None:
+                        book['title'] = title
+                    if author is not None:
+                        book['author'] = author
+                    updated[book_id] = book
+
+                result.append(book)
+
+            self._log([{'op': 'update', 'book': book}
+                       for book in updated.values()])
+
+            old_keys = {'title': [], 'author': []}
+            new_keys = {'title': [], 'author': []}
+
+            for book_id, book in updated.items():
+                old_book = self._books[book_id]
+                seq = self._seqs[book_id]
+
+                for field in ('title', 'author'):
+                    if old_book[field] != book[field]:
+                        old_keys[field].append((old_book[field], seq,
+                                                book_id))
+                        new_keys[field].append((book[field], seq, book_id))
+
+                if old_book != book:
+                    self._search.remove(old_book)
+                    self._search.add(book)
+                self._books[book_id] = book
+
+            self._by_title.remove_many(old_keys['title'])
+            self._by_title.add_many(new_keys['title'])
+            self._by_author.remove_many(old_keys['author'])
+            self._by_author.add_many(new_keys['author'])
+
+            if updated:
+                self._version += 1
+
+        self._snapshot_if_due()
+
+        return result
+
+    def delete(self, book_id):
+        """ This function deletes the book and returns it
+            or None if there is no such book.
+        """
+
+        return self.delete_many([book_id])[0]
+
+    def delete_many(self, book_ids):
+        """ This function deletes several books and returns the list
+            of deleted books, with None for every nonexistent book.
+        """
+
+        result = []
+        seq_keys = []
+        title_keys = []
+        author_keys = []
+
+        with self._lock.write():
+            existing = [book_id for book_id in dict.fromkeys(book_ids)
+                        if book_id in self._books]
+            self._log([{'op': 'delete', 'id': book_id}
+                       for book_id in existing])
+
+            for book_id in book_ids:
+                book = self._books.pop(book_id, None)
+
+                if book is not None:
+                    seq = self._seqs.pop(book_id)
+                    seq_keys.append((seq, book_id))
+                    title_keys.append((book['title'], seq, book_id))
+                    author_keys.append((book['author'], seq, book_id))
+                    self._search.remove(book)
+
+                result.append(book)
+
+            self._by_seq.remove_many(seq_keys)
+            self._by_title.remove_many(title_keys)
+            self._by_author.remove_many(author_keys)
+
+            if seq_keys:
+                self._version += 1
+
+        self._snapshot_if_due()
+
+        return result
+
+    def snapshot(self):
+        """ This function saves all books to the snapshot of the
+            persistence backend, so the log can be started from scratch.
+        """
+
+        if self._backend is None:
+            return
+
+        # Books are never changed in place, so the list can be saved
+        # without the lock:
+        self._backend.save_snapshot(*self._take_snapshot())
+
+    def close(self):
+        """ This function closes the persistence backend. """
+
+        if self._backend is not None:
+            with self._lock.write():
+                self._backend.close()
+
+    def _insert(self, books):
+        seq_keys = []
+        title_keys = []
+        author_keys = []
+
+        for book in books:
+            book_id = book['id']
+            seq = next(self._counter)
+
+            self._books[book_id] = book
+            self._seqs[book_id] = seq
+            seq_keys.append((seq, book_id))
+            title_keys.append((book['title'], seq, book_id))
+            author_keys.append((book['author'], seq, book_id))
+            self._search.add(book)
+
+        self._by_seq.add_many(seq_keys)
+        self._by_title.add_many(title_keys)
+        self._by_author.add_many(author_keys)
+
+    def _log(self, records):
+        if self._backend is not None and records:
+            if self._backend.append(records):
+                self._snapshot_due = True
+
+    def _snapshot_if_due(self):
+        # The change which filled the log only takes the list of books,
+        # and the backend saves it in background:
+        if self._snapshot_due:
+            self._backend.save_snapshot_later(*self._take_snapshot())
+
+    def _take_snapshot(self):
+        # Take consistent list of books and the position in the log:
+        with self._lock.write():
+            books = list(self._books.values())
+            lsn = self._backend.checkpoint()
+            self._snapshot_due = False
+
+        return books, lsn
+
+    def _filter(self, sort, author, title_prefix):
+        # Returns sorted keys of books which match the filters,
+        # or None if there are no filters:
+        ranges = []
+
+        if author is not None:
+            # (author,) goes before all keys of the author, and
+            # (author, inf) goes after them:
+            ranges.append((self._by_author,
+                           self._by_author.bounds((author,),
+                                                  (author, float('inf')))))
+        if title_prefix:
+            end = prefix_end(title_prefix)
+            ranges.append((self._by_title,
+                           self._by_title.bounds(
+                               (title_prefix,),
+                               None if end is None else (end,))))
+
+        if not ranges:
+            return None
+
+        # Read the smallest range and check other filters by books:
+        index, (start, stop) = min(ranges, key=lambda r: r[1][1] - r[1][0])
+        books = [self._books[key[-1]] for key in index.slice(start, stop)]
+
+        if author is not None and index is not self._by_author:
+            books = [book for book in books if book['author'] == author]
+        if title_prefix and index is not self._by_title:
+            books = [book for book in books
+                     if book['title'].startswith(title_prefix)]
+
+        keys = [self._key(sort, book['id']) for book in books]
+
+        # Keys of the title index are already sorted by title:
+        if sort != 'by_title' or index is not self._by_title:
+            keys.sort()
+
+        return keys
+
+    def _index(self, sort):
+        return self._by_title if sort == 'by_title' else self._by_seq
+
+    def _key(self, sort, book_id):
+        seq = self._seqs[book_id]
+
+        if sort == 'by_title':
+            return self._books[book_id]['title'], seq, book_id
+
+        return seq, book_id
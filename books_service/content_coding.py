@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+""" Formats and compression of responses of the books service.
+
+    JSON is always available. MessagePack is offered only if msgpack
+    package is installed, it is more compact and faster to parse than
+    JSON for the lists of books.
+"""
+
+import gzip
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Supported Content-Encoding values in order of preference:
+ENCODINGS = ('gzip', 'deflate')
+
+
+def mimetypes():
+    """ This function returns the list of formats which can be sent,
+        the default one goes first.
+    """
+
+    if msgpack is None:
+        return [JSON]
+
+    return [JSON, MSGPACK]
+
+
+def best_mimetype(accept_mimetypes):
+    """ This function chooses the format of the response
+        by Accept header.
+    """
+
+    return accept_mimetypes.best_match(mimetypes(), default=JSON) or JSON
+
+
+def best_encoding(accept_encodings):
+    """ This function chooses compression of the response
+        by Accept-Encoding header, None means no compression.
+    """
+
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def serialize(data, mimetype):
+    """ This function converts data to the body of the response. """
+
+    if mimetype == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+
+    return (json.dumps(data, ensure_ascii=False, separators=(',', ':')) +
+            '\n').encode('utf8')
+
+
+def compress(body, encoding, level=6):
+    """ This function compresses the body of the response. """
+
+    if encoding == 'gzip':
+        # mtime is fixed, so the same body is always compressed
+        # to the same bytes:
+        return gzip.compress(body, compresslevel=level, mtime=0)
+
+    return zlib.compress(body, level)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import socket
+import traceback
+
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """ This class keeps HTTP/1.1 connections open between requests.
+
+        The handler of Werkzeug closes the connection after every
+        response, because it does not know where the next request
+        starts. Here the body of the request is read to the end before
+        the response is sent, so the connection is kept open if the
+        response has Content-Length (or no body at all).
+
+        Requests with chunked body, HTTP/1.0 requests and requests
+        with 'Connection: close' are passed to Werkzeug as before.
+        An idle connection takes a thread of the server until the
+        client closes it or `timeout` seconds pass.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent with separate writes, which would wait
+    # for delayed ACK of the client on the open connection:
+    disable_nagle_algorithm = True
+
+    def run_wsgi(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+
+        if self.close_connection or length < 0 or \
+                'Transfer-Encoding' in self.headers:
+            self.close_connection = True
+            return super().run_wsgi()
+
+        if self.headers.get('Expect', '').lower().strip(' \t') == \
+                '100-continue':
+            self.wfile.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        self.environ = environ = self.make_environ()
+        body = LimitedStream(self.rfile, length)
+        environ['wsgi.input'] = body
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and self.headers_sent:
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            started[:] = [status, headers]
+
+            return self.wfile.write
+
+        self.headers_sent = False
+        try:
+            app_iter = self.server.app(environ, start_response)
+            try:
+                self._send(app_iter, started, body)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        except (ConnectionError, socket.timeout) as e:
+            self.close_connection = True
+            self.connection_dropped(e, environ)
+        except Exception:
+            if self.server.passthrough_errors:
+                raise
+
+            self.close_connection = True
+            self.server.log('error', 'Error on request %r:\n%s',
+                            self.requestline, traceback.format_exc())
+            if not self.headers_sent:
+                self.send_error(500)
+
+    def _send(self, app_iter, started, body):
+        """ This function sends the response after the body of the
+            request is read, so the next request starts right after it.
+        """
+
+        chunks = iter(app_iter)
+        # Status may be set only with the first chunk of the body:
+        first = next(chunks, b'')
+        body.exhaust()
+
+        status, headers = started
+        code, _, reason = status.partition(' ')
+        code = int(code)
+
+        keep_alive = code in (204, 304) or 100 <= code < 200 or \
+            any(key.lower() == 'content-length' for key, _ in headers)
+
+        self.send_response(code, reason)
+        for key, value in headers:
+            self.send_header(key, value)
+        # This header also sets close_connection of the handler:
+        self.send_header('Connection', 'keep-alive' if keep_alive else 'close')
+        self.end_headers()
+        self.headers_sent = True
+
+        self.wfile.write(first)
+        for data in chunks:
+            self.wfile.write(data)
+        self.wfile.flush()
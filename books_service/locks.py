@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock(object):
+    """ This class allows many readers or one writer at a time.
+
+        Writers have priority: new readers wait while some writer is
+        waiting for the lock, so a flow of reads can not block writes
+        forever. The lock is not reentrant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        """ This function holds the lock for reading. """
+
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        """ This function holds the lock for writing. """
+
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import bisect
+import threading
+from collections import defaultdict
+
+
+# Upper bounds of histogram buckets:
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Histogram(object):
+    """ This class counts observed values by buckets. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last count is for values above all buckets:
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """ This class collects metrics of requests and renders them in
+        Prometheus text format.
+
+        For every route and method it counts requests by status and
+        keeps histograms of latency and response size. Observing one
+        request takes the lock once and costs a few dict lookups.
+        Metrics are kept in memory of the process, so every worker
+        of serve.py reports its own requests.
+    """
+
+    PREFIX = 'books_'
+
+    def __init__(self, latency_buckets=LATENCY_BUCKETS,
+                 size_buckets=SIZE_BUCKETS):
+        self.latency_buckets = latency_buckets
+        self.size_buckets = size_buckets
+
+        # (method, route, status) -> number of requests:
+        self._requests = defaultdict(int)
+        # (method, route) -> Histogram:
+        self._latency = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, status, latency, size=None):
+        """ This function records one request. """
+
+        key = (method, route)
+
+        with self._lock:
+            self._requests[(method, route, status)] += 1
+
+            latency_histogram = self._latency.get(key)
+            if latency_histogram is None:
+                latency_histogram = Histogram(self.latency_buckets)
+                self._latency[key] = latency_histogram
+            latency_histogram.observe(latency)
+
+            # Size of streamed responses is not known:
+            if size is not None:
+                size_histogram = self._sizes.get(key)
+                if size_histogram is None:
+                    size_histogram = Histogram(self.size_buckets)
+                    self._sizes[key] = size_histogram
+                size_histogram.observe(size)
+
+    def render(self, gauges=()):
+        """ This function returns all metrics in Prometheus text
+            format. `gauges` is a list of (name, type, help, value)
+            of metrics which are taken from other parts of the service.
+        """
+
+        lines = []
+
+        with self._lock:
+            self._render_header(lines, 'http_requests_total', 'counter',
+                                'Number of requests.')
+            for (method, route, status), count in \
+                    sorted(self._requests.items()):
+                lines.append(self._line(
+                    'http_requests_total',
+                    {'method': method, 'route': route,
+                     'status': str(status)}, count))
+
+            self._render_histograms(
+                lines, 'http_request_duration_seconds',
+                'Time to handle request in seconds.', self._latency)
+            self._render_histograms(
+                lines, 'http_response_size_bytes',
+                'Size of response body in bytes.', self._sizes)
+
+        for name, metric_type, help_text, value in gauges:
+            self._render_header(lines, name, metric_type, help_text)
+            lines.append(self._line(name, {}, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def _render_histograms(self, lines, name, help_text, histograms):
+        self._render_header(lines, name, 'histogram', help_text)
+
+        for (method, route), histogram in sorted(histograms.items()):
+            labels = {'method': method, 'route': route}
+            cumulative = 0
+
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(self._line(name + '_bucket',
+                                        dict(labels, le=repr(bound)),
+                                        cumulative))
+
+            lines.append(self._line(name + '_bucket',
+                                    dict(labels, le='+Inf'),
+                                    histogram.count))
+            lines.append(self._line(name + '_sum', labels, histogram.sum))
+            lines.append(self._line(name + '_count', labels,
+                                    histogram.count))
+
+    def _render_header(self, lines, name, metric_type, help_text):
+        lines.append('# HELP {0}{1} {2}'.format(self.PREFIX, name,
+                                                help_text))
+        lines.append('# TYPE {0}{1} {2}'.format(self.PREFIX, name,
+                                                metric_type))
+
+    def _line(self, name, labels, value):
+        if labels:
+            name += '{' + ','.join(
+                '{0}="{1}"'.format(key, escape(label))
+                for key, label in sorted(labels.items())) + '}'
+
+        return '{0}{1} {2}'.format(self.PREFIX, name, value)
+
+
+def escape(value):
+    """ This function escapes value of the label. """
+
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import glob
+import json
+import logging
+import os
+import threading
+
+
+FSYNC_POLICIES = ('always', 'batch', 'off')
+
+log = logging.getLogger('books_service.persistence')
+
+
+class LogBackend(object):
+    """ This class saves changes of the book store to disk.
+
+        Every change is written to the append-only log before it is
+        applied. From time to time the whole catalogue is saved to
+        a snapshot and the log is started from scratch, so on startup
+        only the snapshot and the tail of the log are read.
+
+        The log is split into segments: a new segment is started on
+        every snapshot, and segments which are fully covered by the
+        snapshot are removed after the snapshot is saved. Snapshots
+        asked for with `save_snapshot_later()` are saved by background
+        thread, so the change which fills the log does not wait for it.
+
+        fsync policy:
+            'always' - fsync the log after every change,
+            'batch'  - fsync the log from background thread once
+                       in `fsync_interval` seconds if it was changed,
+            'off'    - never fsync, leave it to the OS.
+    """
+
+    SNAPSHOT = 'books.snapshot'
+    SEGMENT = 'books-{0:020d}.log'
+
+    def __init__(self, path, fsync='batch', fsync_interval=1.0,
+                 snapshot_every=10000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {0}'.format(fsync))
+
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+
+        self._lsn = 0
+        # The last record which is in the saved snapshot:
+        self._saved_lsn = 0
+        self._since_snapshot = 0
+        self._log = None
+        self._dirty = False
+        self._io_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+        # (books, lsn) of the snapshot to save in background:
+        self._pending = None
+        self._pending_lock = threading.Lock()
+        self._thread = None
+
+        os.makedirs(path, exist_ok=True)
+
+    def load(self):
+        """ This function reads the snapshot and the log and returns
+            the list of books in insertion order.
+        """
+
+        books = {}
+        snapshot_lsn = 0
+
+        snapshot_path = os.path.join(self.path, self.SNAPSHOT)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, encoding='utf8') as f:
+                snapshot = json.load(f)
+
+            snapshot_lsn = snapshot['lsn']
+            for book in snapshot['books']:
+                books[book['id']] = book
+
+        self._lsn = snapshot_lsn
+        self._saved_lsn = snapshot_lsn
+
+        for segment in self._segments():
+            for record in self._read_segment(segment):
+                if record['lsn'] <= snapshot_lsn:
+                    continue
+
+                if record['op'] == 'delete':
+                    books.pop(record['id'], None)
+                else:
+                    books[record['book']['id']] = record['book']
+
+                self._lsn = record['lsn']
+                self._since_snapshot += 1
+
+        self._open_segment()
+
+        self._thread = threading.Thread(target=self._background_loop,
+                                        daemon=True)
+        self._thread.start()
+
+        return list(books.values())
+
+    def append(self, records):
+        """ This function writes records to the log and returns True
+            if it is time to make new snapshot.
+        """
+
+        lines = []
+        for record in records:
+            self._lsn += 1
+            record['lsn'] = self._lsn
+            lines.append(json.dumps(record) + '\n')
+
+        with self._io_lock:
+            self._log.write(''.join(lines))
+            self._log.flush()
+
+            if self.fsync == 'always':
+                os.fsync(self._log.fileno())
+            else:
+                self._dirty = True
+
+        self._since_snapshot += len(records)
+
+        return bool(self.snapshot_every) and \
+            self._since_snapshot >= self.snapshot_every
+
+    def checkpoint(self):
+        """ This function starts new segment of the log and returns
+            the number of the last record in the previous segments.
+            Must be called when no changes are written to the log.
+        """
+
+        self._open_segment()
+        self._since_snapshot = 0
+
+        return self._lsn
+
+    def save_snapshot_later(self, books, lsn):
+        """ This function asks background thread to save the snapshot.
+            The snapshot replaces the one which is not saved yet.
+        """
+
+        with self._pending_lock:
+            self._pending = (books, lsn)
+
+        self._wake.set()
+
+    def save_snapshot(self, books, lsn):
+        """ This function saves the snapshot of books which contains
+            all changes up to the record `lsn` and removes segments
+            of the log which are not needed anymore.
+        """
+
+        # Only one snapshot is saved at a time:
+        if not self._snapshot_lock.acquire(blocking=False):
+            return
+
+        try:
+            # Snapshots are taken under the lock of the store, but saved
+            # without it, so a newer snapshot may be saved first. The
+            # older one must not replace it: segments after the older
+            # snapshot could be removed already.
+            if lsn <= self._saved_lsn:
+                return
+
+            snapshot_path = os.path.join(self.path, self.SNAPSHOT)
+            tmp_path = snapshot_path + '.tmp'
+
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump({'lsn': lsn, 'books': books}, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_path, snapshot_path)
+            self._saved_lsn = lsn
+
+            with self._io_lock:
+                current = self._log.name
+
+            for segment in self._segments():
+                if segment != current and self._segment_start(segment) <= lsn:
+                    os.remove(segment)
+        finally:
+            self._snapshot_lock.release()
+
+    def close(self):
+        """ This function stops the background thread, which saves
+            the snapshot asked for before, and saves the rest of the log
+            to disk.
+        """
+
+        self._closed.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        with self._io_lock:
+            self._close_segment()
+
+    def _background_loop(self):
+        timeout = self.fsync_interval if self.fsync == 'batch' else None
+
+        while True:
+            self._wake.wait(timeout)
+            self._wake.clear()
+            closed = self._closed.is_set()
+
+            with self._io_lock:
+                if self._dirty and self._log is not None and \
+                        self.fsync == 'batch':
+                    os.fsync(self._log.fileno())
+                    self._dirty = False
+
+            with self._pending_lock:
+                pending, self._pending = self._pending, None
+
+            if pending is not None:
+                # The log still has all changes, so the service goes on
+                # and the next snapshot is tried later:
+                try:
+                    self.save_snapshot(*pending)
+                except Exception:
+                    log.exception('Snapshot of books was not saved')
+
+            if closed:
+                return
+
+    def _open_segment(self):
+        segment = os.path.join(self.path, self.SEGMENT.format(self._lsn + 1))
+
+        with self._io_lock:
+            self._close_segment()
+            self._log = open(segment, 'a', encoding='utf8')
+
+    def _close_segment(self):
+        if self._log is not None:
+            self._log.flush()
+            if self.fsync != 'off':
+                os.fsync(self._log.fileno())
+            self._log.close()
+            self._log = None
+            self._dirty = False
+
+    def _segments(self):
+        pattern = self.SEGMENT.replace('{0:020d}', '*')
+
+        return sorted(glob.glob(os.path.join(self.path, pattern)),
+                      key=self._segment_start)
+
+    def _segment_start(self, segment):
+        return int(os.path.basename(segment).split('-')[1].split('.')[0])
+
+    def _read_segment(self, segment):
+        valid_size = 0
+
+        with open(segment, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+
+                # The last record may be written partially
+                # if the service was killed:
+                if record is None or not line.endswith(b'\n'):
+                    break
+
+                valid_size += len(line)
+                yield record
+
+        # Cut the broken record, so new records are not appended to it:
+        if os.path.getsize(segment) > valid_size:
+            os.truncate(segment, valid_size)
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import cProfile
+import itertools
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+
+class RequestProfile(object):
+    """ This class profiles one request: calls of functions with
+        cProfile, wall and CPU time, and allocations of memory
+        with tracemalloc.
+    """
+
+    def __init__(self, top=20, memory=True):
+        self.top = top
+        self.memory = memory
+
+        self._profiler = cProfile.Profile()
+        self._tracing = False
+
+    def start(self):
+        """ This function starts profiling of current thread. """
+
+        # tracemalloc is global, so it is not stopped at the end
+        # if somebody else started it:
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            tracemalloc.reset_peak()
+
+        self._started = time.perf_counter()
+        self._cpu_started = time.thread_time()
+        self._profiler.enable()
+
+    def stop(self):
+        """ This function stops profiling and returns the summary. """
+
+        self._profiler.disable()
+        result = {'wall_time': time.perf_counter() - self._started,
+                  'cpu_time': time.thread_time() - self._cpu_started,
+                  'functions': self._functions()}
+
+        if self.memory:
+            result['memory'] = self._allocations()
+            if self._tracing:
+                tracemalloc.stop()
+
+        return result
+
+    def _functions(self):
+        """ This function returns functions which took most of the time,
+            with time spent in their calls.
+        """
+
+        stats = pstats.Stats(self._profiler).stats
+        top = sorted(stats.items(), key=lambda item: item[1][3],
+                     reverse=True)[:self.top]
+
+        return [{'function': function_name(function),
+                 'calls': calls,
+                 'own_time': own_time,
+                 'total_time': total_time}
+                for function, (_, calls, own_time, total_time, _) in top]
+
+    def _allocations(self):
+        """ This function returns lines of code which allocated most of
+            the memory that is still in use. Allocations of other threads
+            are counted too, because tracemalloc traces all of them.
+        """
+
+        current, peak = tracemalloc.get_traced_memory()
+        # Memory of profiling itself is not interesting:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, module.__file__)
+             for module in (tracemalloc, cProfile, pstats)] +
+            [tracemalloc.Filter(False, __file__)])
+
+        return {'current': current,
+                'peak': peak,
+                'top': [{'location': '{0}:{1}'.format(
+                             os.path.basename(stat.traceback[0].filename),
+                             stat.traceback[0].lineno),
+                         'size': stat.size,
+                         'count': stat.count}
+                        for stat in snapshot.statistics('lineno')[:self.top]]}
+
+
+class Profiler(object):
+    """ This class profiles requests which asked for it or were
+        sampled, and keeps the last `max_profiles` profiles.
+
+        Only one request is profiled at a time: cProfile and tracemalloc
+        would mix up several requests, so a request which comes while
+        another one is profiled is handled as usual.
+    """
+
+    def __init__(self, max_profiles=50, top=20, memory=True):
+        self.top = top
+        self.memory = memory
+
+        self._profiles = deque(maxlen=max_profiles)
+        self._ids = itertools.count(1)
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+
+    def wants(self, forced, sample_rate):
+        """ This function checks if the request should be profiled. """
+
+        return forced or (sample_rate > 0 and random.random() < sample_rate)
+
+    def start(self):
+        """ This function starts profiling of the request, or returns
+            None if another request is profiled now.
+        """
+
+        if not self._busy.acquire(blocking=False):
+            return None
+
+        try:
+            profile = RequestProfile(top=self.top, memory=self.memory)
+            profile.start()
+        except Exception:
+            self._busy.release()
+            raise
+
+        return profile
+
+    def finish(self, profile, **info):
+        """ This function stops profiling of the request and saves
+            the profile with information about the request.
+        """
+
+        try:
+            result = profile.stop()
+        finally:
+            self._busy.release()
+
+        result.update(info, id=next(self._ids), time=time.time())
+
+        with self._lock:
+            self._profiles.append(result)
+
+        return result
+
+    def profiles(self):
+        """ This function returns saved profiles, the latest first. """
+
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    def get(self, profile_id):
+        """ This function returns saved profile or None. """
+
+        with self._lock:
+            for profile in self._profiles:
+                if profile['id'] == profile_id:
+                    return profile
+
+        return None
+
+
+def function_name(function):
+    """ This function returns readable name of the function
+        from cProfile statistics.
+    """
+
+    filename, line, name = function
+
+    # Built-in functions have no file:
+    if filename == '~':
+        return name
+
+    return '{0}:{1}({2})'.format(os.path.basename(filename), line, name)
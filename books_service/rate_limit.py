@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter(object):
+    """ This class limits rate of requests of every client to every
+        route with token buckets.
+
+        The bucket of a route gets `rate` tokens per second and keeps
+        no more than `burst` of them, every request takes one token.
+        Limits are given with every request, so they may be changed
+        at any time. Rate must be more than 0.
+
+        Buckets of no more than `max_clients` (client, route) pairs are
+        kept: the least recently used ones are dropped, which is the
+        same as giving the client a full bucket.
+
+        Buckets are kept in memory of the process, so every process
+        of the service limits its own requests.
+    """
+
+    def __init__(self, max_clients=100000, clock=time.monotonic):
+        self.max_clients = max_clients
+        self._clock = clock
+
+        # (client, route) -> [tokens, time of last update]:
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def check(self, client, route, rate, burst):
+        """ This function takes a token for the request and returns
+            None, or returns number of seconds after which the client
+            may try again if the bucket is empty.
+        """
+
+        key = (client, route)
+
+        with self._lock:
+            now = self._clock()
+            bucket = self._buckets.get(key)
+
+            if bucket is None:
+                bucket = [burst, now]
+                self._buckets[key] = bucket
+
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return None
+
+            self.rejected += 1
+
+            return (1 - bucket[0]) / rate
+
+
+class ConcurrencyLimiter(object):
+    """ This class admits no more than `max_requests` requests at the
+        same time. Requests above the limit are rejected at once instead
+        of waiting in the queue, so latency of admitted requests does
+        not grow with the load.
+
+        Requests are counted in memory of the process, so every process
+        of the service has its own limit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self, max_requests):
+        """ This function admits the request and returns True,
+            or returns False if there are `max_requests` requests now.
+        """
+
+        with self._lock:
+            if self.in_flight >= max_requests:
+                self.rejected += 1
+                return False
+
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        """ This function marks admitted request as finished. """
+
+        with self._lock:
+            self.in_flight -= 1
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """ This class keeps serialized and compressed responses, so the
+        same data is not serialized and compressed again for every
+        request. Every response is kept with its Content-Encoding.
+
+        Every response is cached for some version of the catalogue.
+        When the catalogue changes, responses for old versions can not
+        be requested anymore, so they are dropped as soon as the cache
+        sees a newer version, and responses built for older versions are
+        not cached. Least recently used responses are evicted when total
+        size of responses is more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+
+        self._responses = OrderedDict()
+        self._size = 0
+        self._version = -1
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._responses)
+
+    def get(self, version, key):
+        """ This function returns cached (body, encoding) pair or None. """
+
+        with self._lock:
+            self._check_version(version)
+
+            cached = None
+            if version == self._version:
+                cached = self._responses.get(key)
+
+            if cached is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._responses.move_to_end(key)
+
+            return cached
+
+    def put(self, version, key, body, encoding=None):
+        """ This function saves response in the cache. """
+
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._check_version(version)
+
+            # Response was built for older version:
+            if version < self._version:
+                return
+
+            old = self._responses.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+
+            self._responses[key] = (body, encoding)
+            self._size += len(body)
+
+            while self._size > self.max_bytes:
+                _, evicted = self._responses.popitem(last=False)
+                self._size -= len(evicted[0])
+                self.evictions += 1
+
+    def stats(self):
+        """ This function returns counters of the cache. """
+
+        with self._lock:
+            return {'responses': len(self._responses),
+                    'bytes': self._size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _check_version(self, version):
+        if version > self._version:
+            self._responses.clear()
+            self._size = 0
+            self._version = version
@@ -2,20 +2,154 @@
 # -*- encoding=utf8 -*-
 
 from uuid import uuid4
+import atexit
+import base64
+import json
+import math
+import time
+import zlib
 import flask
 from flask import Flask
 from flask import request
-from flask_basicauth import BasicAuth
 from flask import jsonify
 
+import content_coding
+from auth import CachedBasicAuth
+from book_store import FIELDS, BookStore
+from keep_alive import KeepAliveRequestHandler
+from metrics import Metrics
+from profiling import Profiler
+from rate_limit import ConcurrencyLimiter, RateLimiter
+from persistence import LogBackend
+from response_cache import ResponseCache
+from sqlite_store import SQLiteDatabase, SQLiteBookStore
+from sessions import SessionRegistry, SQLiteSessionRegistry
+
 
 app = Flask(__name__)
 app.config['BASIC_AUTH_USERNAME'] = 'test_user'
 app.config['BASIC_AUTH_PASSWORD'] = 'test_password'
-basic_auth = BasicAuth(app)
+# Users and PBKDF2 hashes of their passwords (made with
+# `python auth.py <password>`). BASIC_AUTH_USERNAME and
+# BASIC_AUTH_PASSWORD are used if it is empty:
+app.config['BASIC_AUTH_USERS'] = {}
+# Verified credentials are remembered for AUTH_CACHE_TTL seconds,
+# no more than AUTH_CACHE_MAX_SIZE of them:
+app.config['AUTH_CACHE_TTL'] = 60
+app.config['AUTH_CACHE_MAX_SIZE'] = 1000
+# Auth cookies expire after SESSION_TTL seconds, and no more than
+# SESSION_MAX_SIZE cookies are kept at the same time:
+app.config['SESSION_TTL'] = 3600
+app.config['SESSION_MAX_SIZE'] = 100000
+# Max number of books in one page of GET /books with cursor or offset:
+app.config['BOOKS_MAX_PAGE_SIZE'] = 1000
+# Titles up to this length are kept in cursors for sort by title:
+app.config['BOOKS_CURSOR_MAX_TITLE'] = 256
+# Streamed list of books is sent by chunks of about this size:
+app.config['BOOKS_STREAM_CHUNK_SIZE'] = 64 * 1024
+# Max number of books in one request to batch methods:
+app.config['BOOKS_MAX_BATCH_SIZE'] = 10000
+# Books are saved to the log and snapshots in BOOKS_DATA_DIR,
+# or kept only in memory if it is not set. BOOKS_FSYNC is one of
+# 'always', 'batch' (once in BOOKS_FSYNC_INTERVAL seconds) or 'off':
+app.config['BOOKS_DATA_DIR'] = None
+app.config['BOOKS_FSYNC'] = 'batch'
+app.config['BOOKS_FSYNC_INTERVAL'] = 1.0
+app.config['BOOKS_SNAPSHOT_EVERY'] = 10000
+# Storage engine of books: 'memory' or 'sqlite' (BOOKS_SQLITE_PATH file):
+app.config['BOOKS_STORAGE'] = 'memory'
+app.config['BOOKS_SQLITE_PATH'] = 'books.sqlite3'
+# Max total size of serialized responses kept in the cache:
+app.config['RESPONSE_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+# Responses of at least COMPRESS_MIN_SIZE bytes are compressed with
+# gzip or deflate if the client accepts it:
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_LEVEL'] = 6
+# Requests are counted and timed for GET /metrics in Prometheus
+# format. Every worker process reports only its own requests:
+app.config['METRICS_ENABLED'] = True
+# With PROFILING_ENABLED requests are profiled if they have
+# PROFILING_HEADER or are sampled with PROFILING_SAMPLE_RATE (0..1).
+# The last PROFILING_MAX_PROFILES profiles are kept for
+# GET /debug/profiles, with PROFILING_TOP slowest functions and
+# lines which allocated most of the memory:
+app.config['PROFILING_ENABLED'] = False
+app.config['PROFILING_HEADER'] = 'X-Profile'
+app.config['PROFILING_SAMPLE_RATE'] = 0.0
+app.config['PROFILING_MAX_PROFILES'] = 50
+app.config['PROFILING_TOP'] = 20
+app.config['PROFILING_MEMORY'] = True
+# With RATE_LIMIT_ENABLED every client (by IP address) may send
+# `rate` requests per second with bursts of `burst` requests to every
+# route: RATE_LIMITS maps routes to (rate, burst), other routes get
+# RATE_LIMIT_DEFAULT or are not limited if it is None. Buckets of no
+# more than RATE_LIMIT_MAX_CLIENTS clients are kept. Both limits below
+# are kept by every process, so with `serve.py --workers N` a client
+# may get up to N times more requests, and N times more requests are
+# handled at the same time:
+app.config['RATE_LIMIT_ENABLED'] = False
+app.config['RATE_LIMITS'] = {'/login': (5, 20), '/books': (50, 100)}
+app.config['RATE_LIMIT_DEFAULT'] = None
+app.config['RATE_LIMIT_MAX_CLIENTS'] = 100000
+# No more than MAX_CONCURRENT_REQUESTS requests are handled at the same
+# time, others get 503 at once. It does not depend on rate limits,
+# 0 is no limit:
+app.config['MAX_CONCURRENT_REQUESTS'] = 0
+# Routes which are never limited by both limits:
+app.config['RATE_LIMIT_EXEMPT'] = ('/ready', '/metrics')
+# Seconds in Retry-After header of 503 responses:
+app.config['OVERLOAD_RETRY_AFTER'] = 1
+app.config.from_envvar('BOOKS_SERVICE_SETTINGS', silent=True)
+basic_auth = CachedBasicAuth(app, ttl=app.config['AUTH_CACHE_TTL'],
+                             max_size=app.config['AUTH_CACHE_MAX_SIZE'])
+
+BOOKS = None
+METRICS = Metrics()
+PROFILER = Profiler(max_profiles=app.config['PROFILING_MAX_PROFILES'],
+                    top=app.config['PROFILING_TOP'],
+                    memory=app.config['PROFILING_MEMORY'])
+RATE_LIMITER = RateLimiter(max_clients=app.config['RATE_LIMIT_MAX_CLIENTS'])
+CONCURRENCY = ConcurrencyLimiter()
+
+
+def init_storage():
+    """ This function creates books, sessions and the response cache
+        by app.config. Tests call it again to start from scratch.
+    """
+
+    global BOOKS, SESSIONS, RESPONSE_CACHE
+
+    if BOOKS is not None:
+        BOOKS.close()
+
+    if app.config['BOOKS_STORAGE'] == 'sqlite':
+        # Books and sessions are shared by all processes
+        # which use this file:
+        db = SQLiteDatabase(app.config['BOOKS_SQLITE_PATH'],
+                            fsync=app.config['BOOKS_FSYNC'])
+        BOOKS = SQLiteBookStore(db)
+        SESSIONS = SQLiteSessionRegistry(
+            db, ttl=app.config['SESSION_TTL'],
+            max_size=app.config['SESSION_MAX_SIZE'])
+    else:
+        backend = None
+        if app.config['BOOKS_DATA_DIR']:
+            backend = LogBackend(
+                app.config['BOOKS_DATA_DIR'],
+                fsync=app.config['BOOKS_FSYNC'],
+                fsync_interval=app.config['BOOKS_FSYNC_INTERVAL'],
+                snapshot_every=app.config['BOOKS_SNAPSHOT_EVERY'])
+
+        BOOKS = BookStore(backend=backend)
+        SESSIONS = SessionRegistry(ttl=app.config['SESSION_TTL'],
+                                   max_size=app.config['SESSION_MAX_SIZE'])
+
+    RESPONSE_CACHE = ResponseCache(
+        max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES'])
 
-BOOKS = []
-SESSIONS = []
+
+init_storage()
+atexit.register(lambda: BOOKS.close())
 
 
 class InvalidUsage(Exception):
@@ -46,7 +180,239 @@ def verify_cookie(req):
 
     cookie = req.cookies.get('my_cookie', '')
 
-    return cookie in SESSIONS
+    return SESSIONS.verify(cookie)
+
+
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    """ This function is a readiness probe: it answers only when
+        the storage of books is loaded and available.
+    """
+
+    BOOKS.get('')
+
+    return flask.jsonify({'status': 'ready'})
+
+
+@app.before_request
+def start_timer():
+    """ This function remembers when the request was started. """
+
+    if app.config['METRICS_ENABLED']:
+        flask.g.started = time.perf_counter()
+
+
+# This hook is registered before compress_response(), so it runs
+# after it and sees the size of compressed response:
+@app.after_request
+def observe_request(response):
+    """ This function adds the request to metrics. """
+
+    started = flask.g.get('started')
+    if started is None:
+        return response
+
+    # Unknown URLs are counted together, so they do not create
+    # a new series of metrics for every URL:
+    rule = request.url_rule
+    route = rule.rule if rule is not None else 'unmatched'
+
+    # Size is taken from the header: the body of streamed response
+    # must not be read here, so its size is not known:
+    METRICS.observe(request.method, route, response.status_code,
+                    time.perf_counter() - started,
+                    None if response.is_streamed else
+                    response.content_length)
+
+    return response
+
+
+@app.before_request
+def admit_request():
+    """ This function rejects the request if the client sends too
+        many requests, or the service handles too many requests now.
+    """
+
+    # Limits are read from config on every request,
+    # so they may be changed while the service runs:
+    limit_rate = app.config['RATE_LIMIT_ENABLED']
+    max_requests = app.config['MAX_CONCURRENT_REQUESTS']
+    if not limit_rate and not max_requests:
+        return None
+
+    rule = request.url_rule
+    route = rule.rule if rule is not None else 'unmatched'
+    if route in app.config['RATE_LIMIT_EXEMPT']:
+        return None
+
+    limit = app.config['RATE_LIMITS'].get(route,
+                                          app.config['RATE_LIMIT_DEFAULT'])
+    if limit_rate and limit is not None:
+        retry_after = RATE_LIMITER.check(request.remote_addr, route, *limit)
+        if retry_after is not None:
+            return overloaded('Too many requests!', 429, retry_after)
+
+    if max_requests:
+        if not CONCURRENCY.acquire(max_requests):
+            return overloaded('Service is overloaded!', 503,
+                              app.config['OVERLOAD_RETRY_AFTER'])
+        flask.g.admitted = True
+
+    return None
+
+
+@app.teardown_request
+def release_request(error=None):
+    """ This function frees the place of admitted request. """
+
+    if flask.g.pop('admitted', False):
+        CONCURRENCY.release()
+
+
+def overloaded(message, status_code, retry_after):
+    """ This function returns response to rejected request. """
+
+    response = jsonify({'message': message})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(max(math.ceil(retry_after), 1))
+
+    return response
+
+
+@app.before_request
+def start_profile():
+    """ This function starts profiling of the request if it was
+        asked for or the request was sampled.
+    """
+
+    if not app.config['PROFILING_ENABLED']:
+        return
+
+    forced = request.headers.get(app.config['PROFILING_HEADER']) == '1'
+    if PROFILER.wants(forced, app.config['PROFILING_SAMPLE_RATE']):
+        flask.g.profile = PROFILER.start()
+
+
+# This hook runs after compress_response(), so compression
+# is in the profile too:
+@app.after_request
+def finish_profile(response):
+    """ This function saves the profile of the request and returns
+        its id in the header of the response.
+    """
+
+    profile = flask.g.pop('profile', None)
+
+    if profile is not None:
+        result = PROFILER.finish(profile, method=request.method,
+                                 path=request.full_path.rstrip('?'),
+                                 status=response.status_code)
+        response.headers['X-Profile-Id'] = str(result['id'])
+
+    return response
+
+
+@app.teardown_request
+def abort_profile(error=None):
+    """ This function saves the profile of the request which failed
+        with exception, so profiling is not left enabled.
+    """
+
+    profile = flask.g.pop('profile', None)
+
+    if profile is not None:
+        PROFILER.finish(profile, method=request.method,
+                        path=request.full_path.rstrip('?'),
+                        status=500, error=repr(error))
+
+
+@app.route('/debug/profiles', methods=['GET'])
+@basic_auth.required
+def get_profiles():
+    """ This function returns saved profiles of requests. """
+
+    if not app.config['PROFILING_ENABLED']:
+        flask.abort(404)
+
+    return flask.jsonify({'profiles': PROFILER.profiles()})
+
+
+@app.route('/debug/profiles/<int:profile_id>', methods=['GET'])
+@basic_auth.required
+def get_profile(profile_id):
+    """ This function returns one saved profile. """
+
+    profile = PROFILER.get(profile_id) \
+        if app.config['PROFILING_ENABLED'] else None
+
+    if profile is None:
+        flask.abort(404)
+
+    return flask.jsonify(profile)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """ This function returns metrics in Prometheus text format. """
+
+    if not app.config['METRICS_ENABLED']:
+        flask.abort(404)
+
+    gauges = [('catalogue_size', 'gauge', 'Number of books.', len(BOOKS))]
+
+    sessions = SESSIONS.stats()
+    gauges += [
+        ('sessions_active', 'gauge', 'Number of auth cookies.',
+         sessions['sessions']),
+        ('session_hits_total', 'counter', 'Verified auth cookies.',
+         sessions['hits']),
+        ('session_misses_total', 'counter', 'Rejected auth cookies.',
+         sessions['misses']),
+        ('session_hit_ratio', 'gauge', 'Part of verified auth cookies.',
+         hit_ratio(sessions))]
+
+    responses = RESPONSE_CACHE.stats()
+    gauges += [
+        ('response_cache_size_bytes', 'gauge',
+         'Size of cached responses.', responses['bytes']),
+        ('response_cache_hits_total', 'counter',
+         'Responses taken from the cache.', responses['hits']),
+        ('response_cache_misses_total', 'counter',
+         'Responses not found in the cache.', responses['misses']),
+        ('response_cache_hit_ratio', 'gauge',
+         'Part of responses taken from the cache.', hit_ratio(responses))]
+
+    gauges += [
+        ('requests_in_flight', 'gauge',
+         'Requests handled now, if MAX_CONCURRENT_REQUESTS is set.',
+         CONCURRENCY.in_flight),
+        ('requests_shed_total', 'counter',
+         'Requests rejected because of MAX_CONCURRENT_REQUESTS.',
+         CONCURRENCY.rejected),
+        ('rate_limited_total', 'counter',
+         'Requests rejected because of rate limits.',
+         RATE_LIMITER.rejected),
+        ('rate_limit_buckets', 'gauge', 'Clients and routes with limits.',
+         len(RATE_LIMITER))]
+
+    credentials = basic_auth.stats()
+    gauges += [
+        ('auth_cache_hits_total', 'counter',
+         'Logins with credentials verified before.', credentials['hits']),
+        ('auth_cache_misses_total', 'counter',
+         'Logins with credentials which were checked.',
+         credentials['misses'])]
+
+    return flask.Response(METRICS.render(gauges),
+                          mimetype='text/plain; version=0.0.4')
+
+
+def hit_ratio(stats):
+    """ This function returns part of hits among all lookups. """
+
+    lookups = stats['hits'] + stats['misses']
+
+    return stats['hits'] / lookups if lookups else 0
 
 
 @app.route('/login', methods=['GET'])
@@ -57,36 +423,390 @@ def get_auth():
     """
 
     cookie = str(uuid4())
-    SESSIONS.append(cookie)
+    SESSIONS.add(cookie)
 
     return flask.jsonify({'auth_cookie': cookie})
 
 
+def get_int_arg(req, name, default):
+    """ This function returns integer value of request argument
+        or default value if the argument is not a valid integer.
+    """
+
+    try:
+        return int(req.args.get(name, default))
+    except ValueError:
+        return default
+
+
+def encode_cursor(sort, filters, book_id, key, offset):
+    """ This function creates opaque cursor which points to the book
+        next to the given one. `key` is (seq, title) of the book read
+        together with the page, because the book may be deleted since.
+    """
+
+    seq, title = key
+    data = {'sort': sort, 'filters': filters, 'id': book_id,
+            'seq': seq, 'offset': offset}
+
+    # Title allows to find the place of the book after it is deleted,
+    # but long titles would make the cursor too long for URL:
+    if sort == 'by_title' and \
+            len(title) <= app.config['BOOKS_CURSOR_MAX_TITLE']:
+        data['title'] = title
+    raw = json.dumps(data).encode('utf8')
+
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor, sort, filters):
+    """ This function returns (seq, title) of the book which the cursor
+        points to, or None if it is not known, and the number of books
+        before the next page.
+    """
+
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if data['sort'] != sort:
+            raise InvalidUsage('Cursor was created for another sort order!')
+        if data.get('filters', {}) != filters:
+            raise InvalidUsage('Cursor was created for another filters!')
+
+        seq = cursor_int(data['seq'])
+        offset = max(cursor_int(data['offset']), 0)
+        book_id = data['id']
+        title = data.get('title')
+
+        # Cursor may be made by hand, so values are checked before
+        # they are compared with keys of the books:
+        if not isinstance(book_id, str) or \
+                not isinstance(title, (str, type(None))):
+            raise ValueError('Wrong type of cursor value')
+
+        # Long titles are not kept in the cursor, so the title is taken
+        # from the book if it was not deleted:
+        if sort == 'by_title' and title is None:
+            book = BOOKS.get(book_id)
+            if book is None:
+                return None, offset
+            title = book['title']
+    except (ValueError, TypeError, KeyError, OverflowError):
+        raise InvalidUsage('Invalid cursor!')
+
+    return (seq, title), offset
+
+
+def cursor_int(value):
+    """ This function returns integer value of the cursor, which
+        fits in SQLite INTEGER.
+    """
+
+    if type(value) is not int or abs(value) >= 2 ** 63:
+        raise ValueError('Invalid integer in cursor: {0!r}'.format(value))
+
+    return value
+
+
+def wants_stream(req):
+    """ This function checks if client asked to stream the list
+        of books as newline delimited JSON.
+    """
+
+    if req.args.get('stream') == '1':
+        return True
+
+    best = req.accept_mimetypes.best_match(['application/json',
+                                            'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def stream_books(books, chunk_size):
+    """ This generator serializes books one by one, so the whole
+        list is never kept in memory as one JSON string.
+    """
+
+    chunk = []
+    size = 0
+
+    for book in books:
+        line = app.json.dumps(book) + '\n'
+        chunk.append(line)
+        size += len(line)
+
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield ''.join(chunk)
+
+
+def get_fields_arg(req):
+    """ This function returns the list of fields from comma separated
+        `fields` argument, or None if all fields are requested.
+    """
+
+    if 'fields' not in req.args:
+        return None
+
+    fields = [field.strip() for field in req.args['fields'].split(',')]
+    fields = list(dict.fromkeys(field for field in fields if field))
+
+    if not fields or not set(fields) <= set(FIELDS):
+        raise InvalidUsage('Invalid fields!')
+
+    return fields
+
+
+def select_books(req, lazy=False):
+    """ This function returns the list of books selected by request
+        arguments and the cursor of the next page, or None if there
+        is no next page or the request has no cursor.
+
+        With `lazy` books of the request without cursor are returned
+        by an iterator, which reads them from the store one by one.
+    """
+
+    sort_filter = req.args.get('sort', '')
+    sort = 'by_title' if sort_filter == 'by_title' else None
+
+    filters = {}
+    for name in ('author', 'title_prefix'):
+        if name in req.args:
+            filters[name] = req.args[name]
+
+    # Id is needed for the cursor even if it is not requested:
+    fields = get_fields_arg(req)
+    read_fields = fields
+    if fields is not None and 'id' not in fields:
+        read_fields = ['id'] + fields
+
+    list_limit = get_int_arg(req, 'limit', -1)
+    if list_limit <= 0:
+        list_limit = None
+
+    offset = max(get_int_arg(req, 'offset', 0), 0)
+    cursor = req.args.get('cursor')
+
+    if cursor is not None or 'offset' in req.args:
+        max_page_size = app.config['BOOKS_MAX_PAGE_SIZE']
+        if list_limit is None or list_limit > max_page_size:
+            list_limit = max_page_size
+
+    # The page starts right after the book of the cursor, so it is
+    # found by the index without counting the books before it. Only
+    # if the place of the book is unknown, books before it are skipped:
+    start = offset
+    after = None
+    position = offset
+    if cursor:
+        after, cursor_offset = decode_cursor(cursor, sort, filters)
+        position += cursor_offset
+        if after is None:
+            start = position
+
+    # Without cursor there is no next page, so neither one more
+    # book nor ids of the books are read:
+    if cursor is None:
+        read = BOOKS.iter_page if lazy else BOOKS.page
+        return read(sort, start, list_limit, fields=fields, **filters), None
+
+    # Get one more book to know if there is next page:
+    limit = None if list_limit is None else list_limit + 1
+    result, keys = BOOKS.page_with_keys(sort, start, limit,
+                                        fields=read_fields, after=after,
+                                        **filters)
+
+    has_next = list_limit is not None and len(result) > list_limit
+    result = result[:list_limit]
+
+    next_cursor = None
+    if has_next:
+        next_cursor = encode_cursor(sort, filters, result[-1]['id'],
+                                    keys[len(result) - 1],
+                                    position + len(result))
+
+    if read_fields is not fields:
+        for book in result:
+            del book['id']
+
+    return result, next_cursor
+
+
+def respond(data):
+    """ This function returns response in the format which client
+        asked for in Accept header: JSON or MessagePack.
+    """
+
+    mimetype = content_coding.best_mimetype(request.accept_mimetypes)
+    response = flask.Response(content_coding.serialize(data, mimetype),
+                              mimetype=mimetype)
+    response.vary.add('Accept')
+
+    return response
+
+
+def compression_for(req, size):
+    """ This function returns Content-Encoding for the response
+        of given size, or None if it should not be compressed.
+    """
+
+    if size < app.config['COMPRESS_MIN_SIZE']:
+        return None
+
+    return content_coding.best_encoding(req.accept_encodings)
+
+
+@app.after_request
+def compress_response(response):
+    """ This function compresses responses which were not compressed
+        by cached_response(). Streamed responses are not compressed.
+    """
+
+    if response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers or \
+            response.status_code < 200 or response.status_code == 204:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    body = response.get_data()
+    encoding = compression_for(request, len(body))
+
+    if encoding is not None:
+        response.set_data(content_coding.compress(
+            body, encoding, app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = encoding
+
+    return response
+
+
+def cached_response(key, build):
+    """ This function returns response with ETag of current version
+        of books. The body is taken from the cache or created by
+        `build` function, and 304 is returned if the client already
+        has this version of the response.
+
+        Every format and compression of the response has its own
+        ETag and its own place in the cache.
+    """
+
+    mimetype = content_coding.best_mimetype(request.accept_mimetypes)
+    accepted = content_coding.best_encoding(request.accept_encodings)
+    key += (mimetype, accepted)
+
+    version = BOOKS.version()
+    etag = '{0}.{1}.{2:08x}'.format(BOOKS.epoch, version,
+                                    zlib.crc32(repr(key).encode('utf8')))
+
+    if etag in request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        cached = RESPONSE_CACHE.get(version, key)
+
+        if cached is None:
+            body = content_coding.serialize(build(), mimetype)
+            encoding = compression_for(request, len(body))
+
+            if encoding is not None:
+                body = content_coding.compress(
+                    body, encoding, app.config['COMPRESS_LEVEL'])
+
+            cached = (body, encoding)
+            RESPONSE_CACHE.put(version, key, body, encoding)
+
+        body, encoding = cached
+        response = flask.Response(body, mimetype=mimetype)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.vary.update(('Accept', 'Accept-Encoding'))
+
+    return response
+
+
 @app.route('/books', methods=['GET'])
 def get_list_of_books():
-    """ This function returns the list of books. """
+    """ This function returns the list of books.
+
+        With `offset` or `cursor` argument the list is returned by
+        pages of no more than BOOKS_MAX_PAGE_SIZE books. With `cursor`
+        argument (empty value for the first page) the response is
+        {"books": [...], "next_cursor": "..."}, and next_cursor is
+        null on the last page.
+
+        With `author` and/or `title_prefix` arguments only books of
+        this author and with titles starting with this prefix are
+        returned. With `fields` argument, e.g. `fields=id,author`,
+        only these fields of the books are returned.
+
+        With `stream=1` argument or `Accept: application/x-ndjson`
+        header books are streamed one per line, and next cursor
+        is sent in X-Next-Cursor header.
+
+        Responses have ETag of current version of books, so clients
+        can use If-None-Match header to get 304 if nothing changed.
+        With `Accept: application/msgpack` header the list is sent
+        in MessagePack format if msgpack package is installed.
+    """
+
+    if verify_cookie(request):
+
+        if wants_stream(request):
+            result, next_cursor = select_books(request, lazy=True)
+
+            chunk_size = app.config['BOOKS_STREAM_CHUNK_SIZE']
+            response = flask.Response(stream_books(result, chunk_size),
+                                      mimetype='application/x-ndjson')
+            if next_cursor is not None:
+                response.headers['X-Next-Cursor'] = next_cursor
 
-    global BOOKS
+            return response
+
+        def build():
+            result, next_cursor = select_books(request)
+
+            if 'cursor' not in request.args:
+                return result
+
+            return {'books': result, 'next_cursor': next_cursor}
+
+        key = ('books',) + tuple(sorted(request.args.items(multi=True)))
+
+        return cached_response(key, build)
+
+    raise InvalidUsage('No valid auth cookie provided!')
+
+
+@app.route('/books/search', methods=['GET'])
+def search_books():
+    """ This function returns books which have all words of the query
+        `q` in the title or the author, the best matches go first.
+
+        No more than BOOKS_MAX_PAGE_SIZE books are returned, `limit`
+        and `offset` arguments select the page of results.
+    """
 
     if verify_cookie(request):
+        if 'q' not in request.args:
+            raise InvalidUsage('Search query expected!')
 
-        sort_filter = request.args.get('sort', '')
-        list_limit = (request.args.get('limit', -1))
+        def build():
+            max_page_size = app.config['BOOKS_MAX_PAGE_SIZE']
 
-        result = BOOKS
+            limit = get_int_arg(request, 'limit', max_page_size)
+            if limit <= 0 or limit > max_page_size:
+                limit = max_page_size
 
-        if sort_filter == 'by_title':
-            result = sorted(result, key=lambda x: x['title'])
+            offset = max(get_int_arg(request, 'offset', 0), 0)
 
-        try:
-            list_limit = int(list_limit)
-            if list_limit > 0:
-                result = result[:list_limit]
+            return BOOKS.search(request.args['q'], offset, limit)
 
-        except ValueError:
-            pass
+        key = ('search',) + tuple(sorted(request.args.items(multi=True)))
 
-        return flask.jsonify(result)
+        return cached_response(key, build)
 
     raise InvalidUsage('No valid auth cookie provided!')
 
@@ -96,13 +816,9 @@ def get_book(book_id):
     """ This function returns one book from the list. """
 
     if verify_cookie(request):
-        result = {}
-
-        for book in BOOKS:
-            if book['id'] == book_id:
-                result = book
 
-        return flask.jsonify(result)
+        return cached_response(('book', book_id),
+                               lambda: BOOKS.get(book_id) or {})
 
     raise InvalidUsage('No valid auth cookie provided!')
 
@@ -113,19 +829,16 @@ def update_book(book_id):
 
     if verify_cookie(request):
 
-        for i, book in enumerate(BOOKS):
-            # Find the book with this ID:
-            if book['id'] == book_id:
-                book['title'] = request.values.get('title', book['title'])
-                book['author'] = request.values.get('author', book['author'])
-
-                # Update information about this book:
-                BOOKS[i] = book
+        # Update information about the book with this ID:
+        book = BOOKS.update(book_id,
+                            title=request.values.get('title'),
+                            author=request.values.get('author'))
 
-                return flask.jsonify(book)
-        else:
+        if book is None:
             raise InvalidUsage('No book with given ID!', status_code=404)
 
+        return respond(book)
+
     raise InvalidUsage('No valid auth cookie provided!')
 
 
@@ -133,15 +846,10 @@ def update_book(book_id):
 def delete_book(book_id):
     """ This function deletes book from the list. """
 
-    global BOOKS
-
     if verify_cookie(request):
-        # Create new list of book and skip one book
-        # with specified id:
-        new_books = [b for b in BOOKS if b['id'] != book_id]
-        BOOKS = new_books
+        BOOKS.delete(book_id)
 
-        return flask.jsonify({'deleted': book_id})
+        return respond({'deleted': book_id})
 
     raise InvalidUsage('No valid auth cookie provided!')
 
@@ -150,8 +858,6 @@ def delete_book(book_id):
 def add_book():
     """ This function adds new book to the list. """
 
-    global BOOKS
-
     if verify_cookie(request):
         book_id = str(uuid4())
         title = request.values.get('title', '')
@@ -159,13 +865,140 @@ def add_book():
 
         new_book = {'id': book_id, 'title': title, 'author': author}
 
-        # add new book to the list:
-        BOOKS.append(new_book)
+        # add new book to the store:
+        BOOKS.add(new_book)
+
+        return respond(new_book)
+
+    raise InvalidUsage('No valid auth cookie provided!')
+
+
+def get_batch(req):
+    """ This function returns JSON array from the body of batch request. """
+
+    batch = req.get_json(silent=True)
+
+    if not isinstance(batch, list):
+        raise InvalidUsage('JSON array expected!')
+
+    if len(batch) > app.config['BOOKS_MAX_BATCH_SIZE']:
+        raise InvalidUsage('Too many items in one request!', status_code=413)
+
+    return batch
+
+
+def is_valid_book(item, required=()):
+    """ This function checks that item of a batch is a book with
+        string values of all given fields.
+    """
+
+    if not isinstance(item, dict):
+        return False
+
+    for field in required:
+        if field not in item:
+            return False
+
+    for field in ('id', 'title', 'author'):
+        if field in item and not isinstance(item[field], str):
+            return False
+
+    return True
+
+
+@app.route('/add_books', methods=['POST'])
+def add_books():
+    """ This function adds several new books to the list.
+
+        The body is a JSON array of books, the result is the list
+        of new books or error messages in the same order.
+    """
+
+    if verify_cookie(request):
+        result = []
+        new_books = []
+
+        for item in get_batch(request):
+            if is_valid_book(item):
+                new_book = {'id': str(uuid4()),
+                            'title': item.get('title', ''),
+                            'author': item.get('author', 'No Name')}
+                new_books.append(new_book)
+                result.append(new_book)
+            else:
+                result.append({'message': 'Invalid book!'})
+
+        # add all new books to the store at once:
+        BOOKS.add_many(new_books)
+
+        return respond(result)
+
+    raise InvalidUsage('No valid auth cookie provided!')
+
+
+@app.route('/books', methods=['PUT'])
+def update_books():
+    """ This function updates information about several books.
+
+        The body is a JSON array of books with ids, the result is
+        the list of updated books or error messages in the same order.
+    """
+
+    if verify_cookie(request):
+        batch = get_batch(request)
+        changes = [(item['id'], item.get('title'), item.get('author'))
+                   for item in batch if is_valid_book(item, ('id',))]
+
+        updated = iter(BOOKS.update_many(changes))
+        result = []
+
+        for item in batch:
+            if not is_valid_book(item, ('id',)):
+                result.append({'message': 'Invalid book!'})
+                continue
+
+            book = next(updated)
+            if book is None:
+                result.append({'id': item['id'],
+                               'message': 'No book with given ID!'})
+            else:
+                result.append(book)
+
+        return respond(result)
+
+    raise InvalidUsage('No valid auth cookie provided!')
+
+
+@app.route('/books', methods=['DELETE'])
+def delete_books():
+    """ This function deletes several books from the list.
+
+        The body is a JSON array of book ids or books with ids.
+    """
+
+    if verify_cookie(request):
+        batch = get_batch(request)
+        book_ids = []
+        result = []
+
+        for item in batch:
+            if isinstance(item, dict) and is_valid_book(item, ('id',)):
+                item = item['id']
+
+            if isinstance(item, str):
+                book_ids.append(item)
+                result.append({'deleted': item})
+            else:
+                result.append({'message': 'Invalid book id!'})
+
+        BOOKS.delete_many(book_ids)
 
-        return flask.jsonify(new_book)
+        return respond(result)
 
     raise InvalidUsage('No valid auth cookie provided!')
 
 
 if __name__ == "__main__":
-    app.run('0.0.0.0', port=7000)
\ No newline at end of file
+    # Keep connections of clients open between requests:
+    app.run('0.0.0.0', port=7000, threaded=True,
+            request_handler=KeepAliveRequestHandler)
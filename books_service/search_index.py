@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import math
+import re
+from collections import Counter
+
+
+# Longer tokens are cut, so huge titles do not make huge keys:
+MAX_TOKEN_LENGTH = 64
+
+TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """ This function splits text to lower case words, letters of
+        all alphabets and digits are parts of words.
+    """
+
+    return [token[:MAX_TOKEN_LENGTH]
+            for token in TOKEN.findall(text.casefold())]
+
+
+def book_tokens(book):
+    """ This function returns token -> number of occurrences
+        for title and author of the book.
+    """
+
+    return Counter(tokenize(book['title']) + tokenize(book['author']))
+
+
+def idf(books_count, books_with_token):
+    """ This function returns weight of the token: rare tokens
+        are more important than common ones (BM25 formula).
+    """
+
+    return math.log(1 + (books_count - books_with_token + 0.5) /
+                    (books_with_token + 0.5))
+
+
+class SearchIndex(object):
+    """ This class keeps inverted index of books: for every token
+        the books which have it in the title or author.
+
+        A book matches the query if it has all tokens of the query,
+        and its score is the sum of (occurrences * idf) of the tokens.
+        Candidates are taken from the rarest token of the query, so
+        the search costs as much as the number of books with this
+        token, not as the size of the catalogue.
+    """
+
+    def __init__(self):
+        # token -> {book_id: number of occurrences}:
+        self._postings = {}
+
+    def add(self, book):
+        """ This function adds tokens of the book to the index. """
+
+        for token, count in book_tokens(book).items():
+            self._postings.setdefault(token, {})[book['id']] = count
+
+    def remove(self, book):
+        """ This function removes tokens of the book from the index. """
+
+        for token in book_tokens(book):
+            postings = self._postings.get(token)
+
+            if postings is not None:
+                postings.pop(book['id'], None)
+                if not postings:
+                    del self._postings[token]
+
+    def search(self, query, books_count):
+        """ This function returns book_id -> score for all books
+            which match the query.
+        """
+
+        tokens = set(tokenize(query))
+        if not tokens:
+            return {}
+
+        # The rarest token goes first:
+        tokens = sorted(tokens, key=lambda token: (
+            len(self._postings.get(token, ())), token))
+        postings = [self._postings.get(token, {}) for token in tokens]
+        weights = [idf(books_count, len(p)) for p in postings]
+
+        scores = {}
+        for book_id, count in postings[0].items():
+            score = count * weights[0]
+
+            for other, weight in zip(postings[1:], weights[1:]):
+                other_count = other.get(book_id)
+                if other_count is None:
+                    break
+                score += other_count * weight
+            else:
+                scores[book_id] = score
+
+        return scores
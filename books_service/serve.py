@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+""" This script runs the books service with several worker processes.
+
+    The parent process opens the listening socket, starts workers and
+    restarts them if they die. Every worker imports the service after
+    fork, so it does not share connections or locks with the parent,
+    and handles requests with a fixed pool of threads. Connections are
+    kept alive for `--keep-alive` seconds between requests. An open
+    connection takes a thread for this time, so `--threads` should not
+    be less than the number of connections of clients to one worker.
+
+    On SIGTERM or SIGINT workers stop accepting new connections, finish
+    requests in progress and exit after idle connections are closed.
+    Workers which do not exit in `--graceful-timeout` seconds are killed.
+
+    With more than one worker books and sessions must be kept in
+    SQLite (BOOKS_STORAGE = 'sqlite'), because memory of the workers
+    is not shared.
+
+    Example:
+        BOOKS_SERVICE_SETTINGS=prod.cfg python serve.py --workers 0
+"""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+from flask import Config
+from werkzeug.serving import BaseWSGIServer
+
+from keep_alive import KeepAliveRequestHandler
+
+
+log = logging.getLogger('books_service.serve')
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """ This class handles requests with a fixed pool of threads. """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, keep_alive, fd=None):
+        # Idle keep-alive connections are closed after this timeout:
+        handler = type('RequestHandler', (KeepAliveRequestHandler,),
+                       {'timeout': keep_alive})
+
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def close(self):
+        """ This function closes listening socket and waits for
+            requests in progress.
+        """
+
+        self.server_close()
+        self._pool.shutdown(wait=True)
+
+
+def run_worker(sock, args):
+    """ This function runs one worker process. """
+
+    # The service is imported after fork, so every worker
+    # opens its own storage:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from rest_api_service import app
+
+    server = PooledWSGIServer(args.host, args.port, app, args.threads,
+                              args.keep_alive, fd=sock.fileno())
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), so it can not be
+        # called from the thread which runs it:
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    log.info('Worker %s started', os.getpid())
+    server.serve_forever()
+    server.close()
+    log.info('Worker %s stopped', os.getpid())
+
+
+def start_worker(sock, args):
+    """ This function forks new worker process and returns its pid. """
+
+    pid = os.fork()
+
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock, args)
+        except BaseException:
+            log.exception('Worker %s failed', os.getpid())
+            code = 1
+        finally:
+            # Flush the log and close storage of the worker:
+            logging.shutdown()
+            sys.exit(code)
+
+    return pid
+
+
+def wait_ready(host, port, timeout):
+    """ This function waits until the service answers
+        to the readiness probe.
+    """
+
+    if host in ('0.0.0.0', ''):
+        host = '127.0.0.1'
+    url = 'http://{0}:{1}/ready'.format(host, port)
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            with urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            pass
+
+        time.sleep(0.1)
+
+    return False
+
+
+def stop_workers(workers, timeout):
+    """ This function stops workers gracefully and kills
+        the ones which do not stop in time.
+    """
+
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + timeout
+    while workers and time.monotonic() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            workers.discard(pid)
+        else:
+            time.sleep(0.1)
+
+    for pid in workers:
+        log.warning('Worker %s did not stop in time, killing it', pid)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes, 0 - one per CPU core')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='number of threads in every process')
+    parser.add_argument('--keep-alive', type=float, default=5,
+                        help='seconds to keep idle connection open')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='seconds to wait for workers on shutdown')
+    parser.add_argument('--ready-timeout', type=float, default=60,
+                        help='seconds to wait for readiness probe')
+
+    args = parser.parse_args(argv)
+    if args.workers <= 0:
+        args.workers = os.cpu_count() or 1
+
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(process)d %(message)s')
+    args = parse_args(argv)
+
+    config = Config(os.getcwd(), {'BOOKS_STORAGE': 'memory'})
+    config.from_envvar('BOOKS_SERVICE_SETTINGS', silent=True)
+
+    if args.workers > 1 and config['BOOKS_STORAGE'] != 'sqlite':
+        log.error("Several workers need BOOKS_STORAGE = 'sqlite', "
+                  "memory of the workers is not shared")
+        return 1
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(BaseWSGIServer.request_queue_size)
+    sock.set_inheritable(True)
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(1))
+
+    workers = set(start_worker(sock, args) for _ in range(args.workers))
+    log.info('Started %s workers on %s:%s with %s threads each',
+             args.workers, args.host, args.port, args.threads)
+
+    if wait_ready(args.host, args.port, args.ready_timeout):
+        log.info('Service is ready')
+    else:
+        log.error('Service is not ready in %s seconds', args.ready_timeout)
+        stopping.append(1)
+
+    # Restart workers which die until the service is stopped:
+    while not stopping:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+
+        if pid in workers:
+            log.warning('Worker %s died, starting new one', pid)
+            workers.discard(pid)
+            # Do not restart broken workers in a busy loop:
+            time.sleep(1)
+            workers.add(start_worker(sock, args))
+        else:
+            time.sleep(0.2)
+
+    log.info('Stopping workers')
+    stop_workers(workers, args.graceful_timeout)
+    sock.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionRegistry(object):
+    """ This class keeps auth cookies of logged in users.
+
+        Cookies are stored in a dict, so verification of the cookie
+        does not depend on the number of sessions. Every cookie lives
+        for `ttl` seconds after login, and the registry never keeps more
+        than `max_size` cookies: the oldest ones are evicted first.
+        The registry is safe to use from many threads.
+    """
+
+    def __init__(self, ttl=3600, max_size=100000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+
+        # cookie -> expiration time. All cookies have the same TTL,
+        # so the oldest cookie is always the first one to expire:
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def add(self, cookie):
+        """ This function registers new cookie. """
+
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+
+            self._sessions[cookie] = now + self.ttl
+
+            # Drop the oldest sessions if there are too many of them:
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def verify(self, cookie):
+        """ This function checks that cookie is registered
+            and not expired yet.
+        """
+
+        with self._lock:
+            expires = self._sessions.get(cookie)
+
+            if expires is not None and expires <= self._clock():
+                del self._sessions[cookie]
+                self.expirations += 1
+                expires = None
+
+            if expires is None:
+                self.misses += 1
+                return False
+
+            self.hits += 1
+            return True
+
+    def stats(self):
+        """ This function returns counters of the registry. """
+
+        with self._lock:
+            return {'sessions': len(self._sessions),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'expirations': self.expirations,
+                    'evictions': self.evictions}
+
+    def _expire(self, now):
+        """ This function removes expired cookies from the head
+            of the registry.
+        """
+
+        while self._sessions:
+            cookie, expires = next(iter(self._sessions.items()))
+            if expires > now:
+                break
+
+            del self._sessions[cookie]
+            self.expirations += 1
+
+
+class SQLiteSessionRegistry(object):
+    """ This class keeps auth cookies in SQLite database, so all
+        worker processes of the service share the same sessions.
+
+        It has the same interface as SessionRegistry. Expired cookies
+        are removed on every login, and the number of cookies is
+        checked on every `check_size_every` logins, so the registry may
+        keep a bit more than `max_size` cookies for a short time.
+        Counters are kept by every process separately.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        cookie TEXT PRIMARY KEY,
+        expires REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS sessions_by_expires ON sessions (expires);
+    """
+
+    def __init__(self, db, ttl=3600, max_size=100000, check_size_every=100,
+                 clock=time.time):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self.check_size_every = check_size_every
+        self._clock = clock
+        self._logins = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+        db.conn().executescript(self.SCHEMA)
+
+    def __len__(self):
+        conn = self.db.conn()
+
+        return conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def add(self, cookie):
+        """ This function registers new cookie. """
+
+        now = self._clock()
+
+        with self._lock:
+            self._logins += 1
+            check_size = self._logins % self.check_size_every == 0
+
+        with self.db.transaction() as conn:
+            expired = conn.execute('DELETE FROM sessions WHERE expires <= ?',
+                                   (now,)).rowcount
+            conn.execute('INSERT INTO sessions (cookie, expires) '
+                         'VALUES (?, ?)', (cookie, now + self.ttl))
+
+            evicted = 0
+            if check_size:
+                # Drop the oldest sessions if there are too many of them:
+                evicted = conn.execute(
+                    'DELETE FROM sessions WHERE cookie IN ('
+                    ' SELECT cookie FROM sessions ORDER BY expires'
+                    ' LIMIT max((SELECT COUNT(*) FROM sessions) - ?, 0))',
+                    (self.max_size,)).rowcount
+
+        with self._lock:
+            self.expirations += expired
+            self.evictions += evicted
+
+    def verify(self, cookie):
+        """ This function checks that cookie is registered
+            and not expired yet.
+        """
+
+        row = self.db.conn().execute(
+            'SELECT expires FROM sessions WHERE cookie = ?',
+            (cookie,)).fetchone()
+        valid = row is not None and row[0] > self._clock()
+
+        with self._lock:
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return valid
+
+    def stats(self):
+        """ This function returns counters of the registry. """
+
+        sessions = len(self)
+
+        with self._lock:
+            return {'sessions': sessions,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'expirations': self.expirations,
+                    'evictions': self.evictions}
@@ -0,0 +1,518 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from uuid import uuid4
+
+from book_store import FIELDS, prefix_end
+from search_index import book_tokens, idf, tokenize
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_by_title ON books (title, seq);
+CREATE INDEX IF NOT EXISTS books_by_author ON books (author, seq);
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (token, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+"""
+
+# fsync policy of the service -> PRAGMA synchronous:
+SYNCHRONOUS = {'always': 'FULL', 'batch': 'NORMAL', 'off': 'OFF'}
+
+
+class ThreadConnection(object):
+    """ This class keeps connection of one thread and closes it when
+        the thread ends: the thread local value is dropped then, and
+        nothing else refers to this object. The connection itself is
+        in reference cycles of sqlite3 module, so without this it would
+        stay open until the garbage collector finds it.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteDatabase(object):
+    """ This class gives every thread its own connection to SQLite
+        database in WAL mode, so readers do not wait for writers.
+        The connection is closed when its thread ends, so servers
+        with a thread per request do not pile up open connections.
+
+        Connections are not shared with child processes: after fork
+        the child opens new connections. sqlite3 module keeps prepared
+        statements for every connection.
+    """
+
+    def __init__(self, path, fsync='batch', timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.synchronous = SYNCHRONOUS[fsync]
+
+        self._pid = os.getpid()
+        self._local = threading.local()
+        # Connections of dead threads are dropped from this set:
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+
+        self.conn().execute('PRAGMA journal_mode=WAL')
+
+    def conn(self):
+        """ This function returns connection of current thread. """
+
+        if self._pid != os.getpid():
+            # Connections of the parent process can not be used:
+            self._pid = os.getpid()
+            self._local = threading.local()
+            self._connections = weakref.WeakSet()
+            self._connections_lock = threading.Lock()
+
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            # Transactions are started explicitly:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False,
+                                   cached_statements=256)
+            conn.execute('PRAGMA synchronous={0}'.format(self.synchronous))
+
+            # Only the thread keeps the reference to the connection:
+            connection = ThreadConnection(conn)
+            self._local.connection = connection
+
+            with self._connections_lock:
+                self._connections.add(connection)
+
+        return connection.conn
+
+    @contextmanager
+    def transaction(self):
+        """ This function runs write transaction which takes the write
+            lock of the database at the beginning.
+        """
+
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        conn.execute('COMMIT')
+
+    def checkpoint(self):
+        """ This function moves all changes from WAL to the database. """
+
+        self.conn().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        """ This function closes all connections to the database. """
+
+        with self._connections_lock:
+            for connection in list(self._connections):
+                connection.close()
+            self._connections = weakref.WeakSet()
+
+        self._local = threading.local()
+
+
+class SQLiteBookStore(object):
+    """ This class keeps all books of the service in SQLite database.
+
+        It has the same interface as BookStore, but the catalogue does
+        not have to fit in memory, and several processes can share the
+        same database file.
+
+        Books are found by the unique index on id and sorted by seq or
+        by the index on (title, seq), where seq is never reused, so sort
+        and limit are done by SQLite with the same order as BookStore.
+        Pages after a cursor start right after the key of the cursor
+        in the index, so every page costs the same.
+        SQLite compares text as UTF-8 bytes, which gives the same order
+        as comparison of Python strings.
+
+        Filter by author uses the index on (author, seq), and filter
+        by title prefix is a range of the index on (title, seq). Only
+        requested columns are read, so long titles are not loaded when
+        they are not needed.
+
+        Table of tokens is the inverted index for full text search:
+        it has the same tokens and gives the same scores as
+        search_index.SearchIndex.
+
+        Every change of books increases the version in the meta table
+        in the same transaction, and `epoch` is created together with
+        the database, so all processes see the same versions. The number
+        of books is kept in the meta table the same way.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+        conn = db.conn()
+        conn.executescript(SCHEMA)
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) "
+                     "VALUES ('epoch', ?)", (str(uuid4()),))
+        self.epoch = conn.execute(
+            "SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+        # Number of books is kept in meta, so it is not counted
+        # by a scan; databases created before get it counted once:
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) "
+                     "SELECT 'count', COUNT(*) FROM books")
+
+        self._build_search_index()
+
+    def __len__(self):
+        row = self.db.conn().execute(
+            "SELECT value FROM meta WHERE key = 'count'").fetchone()
+
+        return row[0]
+
+    def __contains__(self, book_id):
+        return self.seq(book_id) is not None
+
+    def all(self):
+        """ This function returns the list of books in insertion order. """
+
+        return self.page()
+
+    def page(self, sort=None, start=0, limit=None, author=None,
+             title_prefix=None, fields=None, after=None):
+        """ This function returns `limit` books starting from position
+            `start` in insertion order or, with sort='by_title',
+            sorted by title. If `after` is (seq, title) of some book,
+            positions are counted from the book next to it, even if
+            that book was deleted.
+
+            Only books of given author and/or with given title prefix
+            are returned if these filters are set, and only given
+            fields of the books if `fields` is set.
+        """
+
+        return list(self.iter_page(sort, start, limit, author,
+                                   title_prefix, fields, after))
+
+    def iter_page(self, sort=None, start=0, limit=None, author=None,
+                  title_prefix=None, fields=None, after=None):
+        """ This function returns the same books as page() one by one.
+            Rows are read from the database while the books are read,
+            so the whole page is never kept in memory.
+        """
+
+        fields = FIELDS if fields is None else fields
+        rows = self._page(sort, start, limit, author, title_prefix, after,
+                          fields)
+
+        return (dict(zip(fields, row)) for row in rows)
+
+    def page_with_keys(self, sort=None, start=0, limit=None, author=None,
+                       title_prefix=None, fields=None, after=None):
+        """ This function returns the same books as page() and the list
+            of (seq, title) of every book, read with the same query.
+        """
+
+        fields = FIELDS if fields is None else fields
+        rows = self._page(sort, start, limit, author, title_prefix, after,
+                          ('seq', 'title') + tuple(fields)).fetchall()
+
+        return ([dict(zip(fields, row[2:])) for row in rows],
+                [row[:2] for row in rows])
+
+    def search(self, query, start=0, limit=None):
+        """ This function returns `limit` books starting from position
+            `start` in the list of books which have all words of the
+            query, books with the best score go first.
+        """
+
+        conn = self.db.conn()
+        books_count = len(self)
+
+        counts = {}
+        for token in set(tokenize(query)):
+            counts[token] = conn.execute(
+                'SELECT COUNT(*) FROM tokens WHERE token = ?',
+                (token,)).fetchone()[0]
+
+        if not counts or not all(counts.values()):
+            return []
+
+        # Books are taken from the rarest token and found
+        # for other tokens by the primary key:
+        tokens = sorted(counts, key=lambda token: (counts[token], token))
+        weights = [idf(books_count, counts[token]) for token in tokens]
+
+        score = ' + '.join('t{0}.count * ?'.format(i)
+                           for i in range(len(tokens)))
+        joins = ''.join(' JOIN tokens t{0} ON t{0}.token = ? AND '
+                        't{0}.seq = t0.seq'.format(i)
+                        for i in range(1, len(tokens)))
+        sql = ('SELECT id, title, author FROM '
+               '(SELECT t0.seq AS seq, {0} AS score FROM tokens t0{1} '
+               'WHERE t0.token = ?) AS found '
+               'JOIN books ON books.seq = found.seq '
+               'ORDER BY score DESC, found.seq '
+               'LIMIT ? OFFSET ?').format(score, joins)
+
+        limit = -1 if limit is None else limit
+        args = weights + tokens[1:] + [tokens[0], limit, start]
+
+        return [self._book(row) for row in conn.execute(sql, args)]
+
+    def version(self):
+        """ This function returns current version of the store. """
+
+        row = self.db.conn().execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+
+        return row[0]
+
+    def seq(self, book_id):
+        """ This function returns sequence number of the book. """
+
+        row = self.db.conn().execute('SELECT seq FROM books WHERE id = ?',
+                                   (book_id,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def get(self, book_id):
+        """ This function returns one book or None. """
+
+        row = self.db.conn().execute(
+            'SELECT id, title, author FROM books WHERE id = ?',
+            (book_id,)).fetchone()
+
+        return None if row is None else self._book(row)
+
+    def add(self, book):
+        """ This function adds new book to the store. """
+
+        return self.add_many([book])[0]
+
+    def add_many(self, books):
+        """ This function adds several books to the store. """
+
+        with self.db.transaction() as conn:
+            for book in books:
+                seq = conn.execute(
+                    'INSERT INTO books (id, title, author) VALUES (?, ?, ?)',
+                    (book['id'], book['title'], book['author'])).lastrowid
+                self._add_tokens(conn, seq, book)
+
+            if books:
+                self._bump_version(conn, len(books))
+
+        return books
+
+    def update(self, book_id, title=None, author=None):
+        """ This function updates title and/or author of the book
+            and returns updated book or None if there is no such book.
+        """
+
+        return self.update_many([(book_id, title, author)])[0]
+
+    def update_many(self, changes):
+        """ This function applies several (book_id, title, author)
+            changes and returns the list of updated books, with None
+            for every change of nonexistent book.
+        """
+
+        result = []
+
+        with self.db.transaction() as conn:
+            for book_id, title, author in changes:
+                row = conn.execute(
+                    'SELECT seq, id, title, author FROM books WHERE id = ?',
+                    (book_id,)).fetchone()
+
+                if row is None:
+                    result.append(None)
+                    continue
+
+                seq = row[0]
+                old_book = self._book(row[1:])
+                book = dict(old_book)
+                if title is not None:
+                    book['title'] = title
+                if author is not None:
+                    book['author'] = author
+
+                conn.execute(
+                    'UPDATE books SET title = ?, author = ? WHERE id = ?',
+                    (book['title'], book['author'], book_id))
+
+                if book != old_book:
+                    self._remove_tokens(conn, seq, old_book)
+                    self._add_tokens(conn, seq, book)
+
+                result.append(book)
+
+            if any(book is not None for book in result):
+                self._bump_version(conn)
+
+        return result
+
+    def delete(self, book_id):
+        """ This function deletes the book and returns it
+            or None if there is no such book.
+        """
+
+        return self.delete_many([book_id])[0]
+
+    def delete_many(self, book_ids):
+        """ This function deletes several books and returns the list
+            of deleted books, with None for every nonexistent book.
+        """
+
+        result = []
+
+        with self.db.transaction() as conn:
+            for book_id in book_ids:
+                row = conn.execute(
+                    'SELECT seq, id, title, author FROM books WHERE id = ?',
+                    (book_id,)).fetchone()
+
+                book = None
+                if row is not None:
+                    book = self._book(row[1:])
+                    conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+                    self._remove_tokens(conn, row[0], book)
+
+                result.append(book)
+
+            deleted = sum(book is not None for book in result)
+            if deleted:
+                self._bump_version(conn, -deleted)
+
+        return result
+
+    def snapshot(self):
+        """ This function moves all changes from WAL to the database. """
+
+        self.db.checkpoint()
+
+    def close(self):
+        """ This function closes all connections to the database. """
+
+        self.db.close()
+
+    def _build_search_index(self):
+        # Databases created before full text search get
+        # the table of tokens filled once:
+        with self.db.transaction() as conn:
+            built = conn.execute(
+                "SELECT value FROM meta WHERE key = 'tokens'").fetchone()
+
+            if built is None:
+                rows = conn.execute('SELECT seq, id, title, author '
+                                    'FROM books').fetchall()
+                for row in rows:
+                    self._add_tokens(conn, row[0], self._book(row[1:]))
+
+                conn.execute("INSERT INTO meta (key, value) "
+                             "VALUES ('tokens', 1)")
+
+    @staticmethod
+    def _add_tokens(conn, seq, book):
+        conn.executemany(
+            'INSERT INTO tokens (token, seq, count) VALUES (?, ?, ?)',
+            [(token, seq, count)
+             for token, count in book_tokens(book).items()])
+
+    @staticmethod
+    def _remove_tokens(conn, seq, book):
+        conn.executemany('DELETE FROM tokens WHERE token = ? AND seq = ?',
+                         [(token, seq) for token in book_tokens(book)])
+
+    def _page(self, sort, start, limit, author, title_prefix, after,
+              columns):
+        where, args = self._where(author, title_prefix)
+        order = 'title, seq' if sort == 'by_title' else 'seq'
+
+        # Keyset pagination: the page starts right after the key in the
+        # index, so books before it are neither counted nor skipped:
+        if after is not None:
+            seq, title = after
+            where += ' AND ' if where else 'WHERE '
+
+            if sort == 'by_title':
+                where += '(title, seq) > (?, ?)'
+                args += [title, seq]
+            else:
+                where += 'seq > ?'
+                args += [seq]
+
+        # Names of the fields are checked, so they can be put in SQL:
+        if not set(columns) <= set(FIELDS) | {'seq'}:
+            raise ValueError('Unknown fields: {0}'.format(columns))
+
+        sql = ('SELECT {0} FROM books {1} '
+               'ORDER BY {2} LIMIT ? OFFSET ?').format(', '.join(columns),
+                                                       where, order)
+
+        limit = -1 if limit is None else limit
+
+        return self.db.conn().execute(sql, args + [limit, start])
+
+    @staticmethod
+    def _where(author, title_prefix):
+        conditions = []
+        args = []
+
+        if author is not None:
+            conditions.append('author = ?')
+            args.append(author)
+
+        if title_prefix:
+            # Range condition uses the index, unlike LIKE:
+            conditions.append('title >= ?')
+            args.append(title_prefix)
+
+            end = prefix_end(title_prefix)
+            if end is not None:
+                conditions.append('title < ?')
+                args.append(end)
+
+        if not conditions:
+            return '', args
+
+        return 'WHERE ' + ' AND '.join(conditions), args
+
+    @staticmethod
+    def _bump_version(conn, added=0):
+        conn.execute("UPDATE meta SET value = value + 1 "
+                     "WHERE key = 'version'")
+
+        if added:
+            conn.execute("UPDATE meta SET value = value + ? "
+                         "WHERE key = 'count'", (added,))
+
+    @staticmethod
+    def _book(row):
+        return {'id': row[0], 'title': row[1], 'author': row[2]}
+
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from tests import utils
+
+
+class AsyncClient(object):
+    """ This class is asyncio version of helpers from tests/utils.py.
+
+        Requests are sent by the same pooled client from a pool of
+        threads, so connections to the service are reused, and no more
+        than `concurrency` requests are sent at the same time.
+
+        Example:
+            async with AsyncClient() as client:
+                books = await client.add_many([{'title': 'A'}] * 10)
+    """
+
+    def __init__(self, concurrency=utils.pool_size):
+        self.concurrency = concurrency
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def call(self, func, *args, **kwargs):
+        """ This function runs blocking helper in the pool of threads. """
+
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs))
+
+    async def get_all_books(self, filters=None):
+        """ This function returns full list of books. """
+
+        return await self.call(utils.get_all_books, filters)
+
+    async def get_book(self, book_id):
+        """ This function returns one book. """
+
+        return await self.call(utils.get_book, book_id)
+
+    async def add_book(self, book):
+        """ This function creates new book. """
+
+        return await self.call(utils.add_book, book)
+
+    async def update_book(self, book_id, book):
+        """ This function updates information about the book. """
+
+        return await self.call(utils.update_book, book_id, book)
+
+    async def delete_book(self, book_id):
+        """ This function deletes the book. """
+
+        return await self.call(utils.delete_book, book_id)
+
+    async def gather(self, calls):
+        """ This function runs several coroutines at the same time
+            and returns their results in the same order.
+        """
+
+        return await asyncio.gather(*calls)
+
+    async def get_many(self, book_ids):
+        """ This function returns several books with parallel requests. """
+
+        return await self.gather(self.get_book(book_id)
+                                 for book_id in book_ids)
+
+    async def add_many(self, books):
+        """ This function creates several books with parallel requests. """
+
+        return await self.gather(self.add_book(book) for book in books)
+
+    async def update_many(self, changes):
+        """ This function applies several (book_id, book) changes
+            with parallel requests.
+        """
+
+        return await self.gather(self.update_book(book_id, book)
+                                 for book_id, book in changes)
+
+    async def delete_many(self, book_ids):
+        """ This function deletes several books with parallel requests. """
+
+        return await self.gather(self.delete_book(book_id)
+                                 for book_id in book_ids)
+
+    def close(self):
+        """ This function waits for requests in progress and stops
+            the pool of threads.
+        """
+
+        self._executor.shutdown(wait=True)
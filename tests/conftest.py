@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+from tests import utils
+
+
+SERVICE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'books_service')
+# Modules of the service are imported by tests as top level modules,
+# the same way they import each other:
+sys.path.insert(0, SERVICE_DIR)
+
+
+class LocalService(object):
+    """ This class runs the service in a thread of the test process
+        on a free port, with books and sessions kept in memory or in
+        SQLite database in a temporary directory.
+        With 'wsgi' transport there is no server at all: the client
+        of tests calls the application directly.
+
+        Every worker of pytest-xdist is a separate process, so it gets
+        its own instance of the service, and tests of different
+        workers do not see books of each other.
+    """
+
+    # Requests to this address never leave the process:
+    WSGI_URL = 'http://books-service.wsgi'
+
+    def __init__(self, transport='http', storage='memory'):
+        import rest_api_service
+        from keep_alive import KeepAliveRequestHandler
+
+        self.module = rest_api_service
+        self.storage = storage
+        self.data_dir = None
+        if storage == 'sqlite':
+            self.data_dir = tempfile.mkdtemp(prefix='books_service_')
+        self._databases = itertools.count()
+        self._init_storage()
+
+        self.server = None
+        if transport == 'wsgi':
+            self.url = self.WSGI_URL
+            utils.client.mount_wsgi(self.url, self.module.app)
+            return
+
+        # Connections of the pooled client are kept open:
+        self.server = make_server('127.0.0.1', 0, self.module.app,
+                                  threaded=True,
+                                  request_handler=KeepAliveRequestHandler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+
+    def reset(self):
+        """ This function drops all books and sessions. """
+
+        self._init_storage()
+        utils.tokens.clear()
+
+    def _init_storage(self):
+        config = self.module.app.config
+        config.update(BOOKS_STORAGE=self.storage, BOOKS_DATA_DIR=None)
+
+        # Every reset starts with a new database:
+        if self.data_dir is not None:
+            config['BOOKS_SQLITE_PATH'] = os.path.join(
+                self.data_dir,
+                'books{0}.sqlite3'.format(next(self._databases)))
+
+        self.module.init_storage()
+
+    def stop(self):
+        """ This function stops the service. """
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+        if self.data_dir is not None:
+            self.module.BOOKS.close()
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def pytest_configure(config):
+    # The controller of pytest-xdist does not run tests:
+    if getattr(config.option, 'numprocesses', None) and \
+            not hasattr(config, 'workerinput'):
+        return
+
+    # The service is started before test modules are imported,
+    # so they get its address with `from tests.utils import *`:
+    if utils.start_service:
+        config.books_service = LocalService(utils.transport,
+                                             utils.storage)
+        utils.host = config.books_service.url
+
+
+def pytest_unconfigure(config):
+    service = getattr(config, 'books_service', None)
+
+    if service is not None:
+        service.stop()
+
+
+@pytest.fixture(scope='session')
+def service(pytestconfig):
+    """ This fixture returns the service started by tests,
+        or None if tests use `host` from test_config.conf.
+    """
+
+    return getattr(pytestconfig, 'books_service', None)
+
+
+@pytest.fixture
+def local_service(service):
+    """ This fixture returns the service started by tests, and skips
+        the test if tests use `host` from test_config.conf, because
+        the test changes config or objects of the service.
+    """
+
+    if service is None:
+        pytest.skip('the test needs the service started by tests')
+
+    return service
+
+
+@pytest.fixture
+def clean_service(service):
+    """ This fixture starts the test with empty service if tests
+        run their own instance. It is not used by default, because
+        some tests expect books added by previous tests.
+    """
+
+    if service is not None:
+        service.reset()
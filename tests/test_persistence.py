@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import glob
+import os
+import threading
+from uuid import uuid4
+
+from book_store import BookStore
+from persistence import LogBackend
+
+
+def make_book(title):
+    """ This function creates new book with given title. """
+
+    return {'id': str(uuid4()), 'title': title, 'author': 'Pushkin'}
+
+
+def open_store(data_dir, **kwargs):
+    """ This function opens the store of books saved in data_dir. """
+
+    kwargs.setdefault('fsync', 'off')
+    kwargs.setdefault('snapshot_every', 0)
+
+    return BookStore(backend=LogBackend(str(data_dir), **kwargs))
+
+
+def segments(data_dir):
+    """ This function returns names of segments of the log. """
+
+    return sorted(os.path.basename(path)
+                  for path in glob.glob(str(data_dir / 'books-*.log')))
+
+
+def test_books_are_loaded_from_snapshot_and_log(tmp_path):
+    """ Check that books are loaded from the snapshot and the changes
+        written to the log after it. """
+
+    store = open_store(tmp_path)
+    books = store.add_many([make_book('A'), make_book('B'), make_book('C')])
+    store.snapshot()
+
+    store.update(books[0]['id'], title='D')
+    store.delete(books[1]['id'])
+    book = store.add(make_book('E'))
+    expected = store.all()
+    store.close()
+
+    store = open_store(tmp_path)
+    assert store.all() == expected, 'wrong books after restart'
+    assert store.page('by_title') == [dict(books[2]),
+                                      dict(books[0], title='D'), book]
+    store.close()
+
+
+def test_torn_last_record_is_dropped(tmp_path):
+    """ Check that the record which was written partially when the
+        service was killed is dropped, and new records are written
+        after the last valid one. """
+
+    store = open_store(tmp_path)
+    books = store.add_many([make_book('A'), make_book('B')])
+    store.close()
+
+    segment = str(tmp_path / segments(tmp_path)[-1])
+    with open(segment, 'a', encoding='utf8') as f:
+        f.write('{"op": "add", "book": {"id": "x", "tit')
+
+    store = open_store(tmp_path)
+    assert store.all() == books, 'wrong books after torn record'
+    book = store.add(make_book('C'))
+    store.close()
+
+    store = open_store(tmp_path)
+    assert store.all() == books + [book], 'new record was lost'
+    store.close()
+
+
+def test_segments_are_removed_after_snapshot(tmp_path):
+    """ Check that segments of the log which are in the snapshot are
+        removed, and the log is started from scratch. """
+
+    store = open_store(tmp_path)
+    for title in ('A', 'B', 'C'):
+        store.add(make_book(title))
+        store.snapshot()
+
+    assert len(segments(tmp_path)) == 1, 'old segments were not removed'
+    assert os.path.exists(str(tmp_path / LogBackend.SNAPSHOT))
+
+    expected = store.all()
+    store.close()
+
+    store = open_store(tmp_path)
+    assert store.all() == expected, 'wrong books after restart'
+    store.close()
+
+
+def test_older_snapshot_does_not_replace_newer_one(tmp_path):
+    """ Check that the snapshot which was taken earlier but saved
+        later does not replace the newer one. """
+
+    backend = LogBackend(str(tmp_path), fsync='off', snapshot_every=0)
+    backend.load()
+
+    first = make_book('A')
+    backend.append([{'op': 'add', 'book': first}])
+    old_lsn = backend.checkpoint()
+
+    second = make_book('B')
+    backend.append([{'op': 'add', 'book': second}])
+    new_lsn = backend.checkpoint()
+
+    backend.save_snapshot([first, second], new_lsn)
+    backend.save_snapshot([first], old_lsn)
+    backend.close()
+
+    backend = LogBackend(str(tmp_path), fsync='off')
+    assert backend.load() == [first, second], 'newer snapshot was replaced'
+    backend.close()
+
+
+def test_snapshot_is_saved_in_background(tmp_path):
+    """ Check that the change which fills the log does not save
+        the snapshot itself, and it is saved before the store is
+        closed. """
+
+    store = open_store(tmp_path, snapshot_every=3)
+    backend = store._backend
+
+    threads = []
+    save_snapshot = backend.save_snapshot
+
+    def save_in_thread(books, lsn):
+        threads.append(threading.current_thread())
+        save_snapshot(books, lsn)
+
+    backend.save_snapshot = save_in_thread
+
+    books = store.add_many([make_book('A'), make_book('B'), make_book('C')])
+    store.close()
+
+    assert threads, 'snapshot was not saved'
+    assert threading.current_thread() not in threads, \
+        'snapshot was saved by the change'
+    assert len(segments(tmp_path)) == 1, 'old segments were not removed'
+
+    store = open_store(tmp_path)
+    assert store.all() == books, 'wrong books after restart'
+    store.close()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+import serve
+
+
+def free_port():
+    """ This function returns a port which nobody listens to now. """
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_several_workers_need_sqlite(monkeypatch):
+    """ Check that serve.py refuses to start several workers which
+        keep books in memory. """
+
+    monkeypatch.delenv('BOOKS_SERVICE_SETTINGS', raising=False)
+
+    assert serve.main(['--workers', '2', '--port', str(free_port())]) == 1
+
+
+def test_graceful_shutdown(tmp_path):
+    """ Check that serve.py answers when it is ready, and stops on
+        SIGTERM while a client keeps the connection open. """
+
+    port = free_port()
+    env = dict(os.environ)
+    env.pop('BOOKS_SERVICE_SETTINGS', None)
+
+    process = subprocess.Popen(
+        [sys.executable, serve.__file__,
+         '--host', '127.0.0.1', '--port', str(port), '--workers', '1',
+         '--threads', '2', '--keep-alive', '1', '--ready-timeout', '30'],
+        cwd=str(tmp_path), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    try:
+        # The parent logs when the readiness probe answers:
+        for line in process.stdout:
+            if b'Service is ready' in line:
+                break
+        else:
+            raise AssertionError('service did not start')
+
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/ready')
+        response = conn.getresponse()
+        assert response.status == 200, 'service is not ready'
+        assert response.read() and \
+            response.getheader('Connection') == 'keep-alive'
+
+        # The idle connection is closed after --keep-alive seconds,
+        # so the worker does not wait for the client forever:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=20) == 0, 'service did not stop'
+        conn.close()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+from uuid import uuid4
+
+import pytest
+
+from sessions import SessionRegistry, SQLiteSessionRegistry
+from sqlite_store import SQLiteDatabase
+
+
+class Clock(object):
+    """ This class is a clock of tests, which moves only when
+        it is told to.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def open_registry(storage, data_dir, **kwargs):
+    """ This function creates the registry of sessions of given type. """
+
+    if storage == 'sqlite':
+        db = SQLiteDatabase(str(data_dir / 'sessions.sqlite3'))
+        # Number of cookies is checked on every login, as in memory:
+        kwargs.setdefault('check_size_every', 1)
+        return SQLiteSessionRegistry(db, **kwargs)
+
+    return SessionRegistry(**kwargs)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def storage(request):
+    """ This fixture returns every type of storage of sessions. """
+
+    return request.param
+
+
+def test_verify_cookie(storage, tmp_path):
+    """ Check that only registered cookies are verified. """
+
+    registry = open_registry(storage, tmp_path)
+    cookie = str(uuid4())
+    registry.add(cookie)
+
+    assert registry.verify(cookie), 'registered cookie is rejected'
+    assert not registry.verify(str(uuid4())), 'unknown cookie is verified'
+    assert len(registry) == 1, 'wrong number of sessions'
+
+
+def test_sqlite_sessions_are_shared(tmp_path):
+    """ Check that registries of the same database see cookies
+        of each other, as registries of worker processes do. """
+
+    first = open_registry('sqlite', tmp_path)
+    second = open_registry('sqlite', tmp_path)
+
+    cookie = str(uuid4())
+    first.add(cookie)
+
+    assert second.verify(cookie), 'cookie is not shared'
+
+
+def test_cookie_expires(storage, tmp_path):
+    """ Check that cookie is rejected after its TTL. """
+
+    clock = Clock()
+    registry = open_registry(storage, tmp_path, ttl=10, clock=clock)
+    cookie = str(uuid4())
+    registry.add(cookie)
+
+    clock.now += 9
+    assert registry.verify(cookie), 'cookie expired too early'
+
+    clock.now += 1
+    assert not registry.verify(cookie), 'expired cookie is verified'
+
+
+def test_oldest_cookie_is_evicted(storage, tmp_path):
+    """ Check that the oldest cookies are dropped when there are
+        more than `max_size` of them. """
+
+    clock = Clock()
+    registry = open_registry(storage, tmp_path, max_size=2, clock=clock)
+
+    cookies = [str(uuid4()) for _ in range(3)]
+    for cookie in cookies:
+        registry.add(cookie)
+        clock.now += 1
+
+    assert len(registry) == 2, 'wrong number of sessions'
+    assert not registry.verify(cookies[0]), 'oldest cookie was not evicted'
+    assert registry.verify(cookies[1]) and registry.verify(cookies[2]), \
+        'new cookies were evicted'
+    assert registry.stats()['evictions'] == 1, 'eviction was not counted'
+
+
+def test_counters_of_sessions(tmp_path):
+    """ Check hits, misses and expirations of sessions. """
+
+    clock = Clock()
+    registry = open_registry('memory', tmp_path, ttl=10, clock=clock)
+    cookies = [str(uuid4()) for _ in range(2)]
+
+    registry.add(cookies[0])
+    registry.verify(cookies[0])
+    registry.verify(str(uuid4()))
+
+    # The first cookie expires and is removed by the next login:
+    clock.now += 10
+    registry.add(cookies[1])
+    registry.verify(cookies[1])
+
+    assert registry.stats() == {'sessions': 1, 'hits': 2, 'misses': 1,
+                                'expirations': 1, 'evictions': 0}
+
+    # Expired cookie is removed when it is verified too:
+    clock.now += 10
+    assert not registry.verify(cookies[1])
+    assert registry.stats() == {'sessions': 0, 'hits': 2, 'misses': 2,
+                                'expirations': 2, 'evictions': 0}
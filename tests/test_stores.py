@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+# -*- encoding=utf8 -*-
+
+import random
+import threading
+from uuid import uuid4
+
+import pytest
+
+from book_store import BookStore
+from sqlite_store import SQLiteDatabase, SQLiteBookStore
+
+
+def open_store(storage, data_dir):
+    """ This function creates the store of books of given type. """
+
+    if storage == 'sqlite':
+        path = str(data_dir / 'books.sqlite3')
+        return SQLiteBookStore(SQLiteDatabase(path))
+
+    return BookStore()
+
+
+def make_books(titles, author='Pushkin'):
+    """ This function creates new books with given titles. """
+
+    return [{'id': str(uuid4()), 'title': title, 'author': author}
+            for title in titles]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    """ This fixture returns empty store of every type. """
+
+    store = open_store(request.param, tmp_path)
+    yield store
+    store.close()
+
+
+def test_add_update_and_delete_book(store):
+    """ Check that a book is found after it is added, updated
+        and is not found after it is deleted. """
+
+    book = store.add(make_books(['A'])[0])
+    assert store.get(book['id']) == book, 'book was not added'
+    assert book['id'] in store, 'book is not in the store'
+    assert len(store) == 1, 'wrong number of books'
+
+    updated = store.update(book['id'], title='B')
+    assert updated == dict(book, title='B'), 'wrong updated book'
+    assert store.get(book['id']) == updated, 'book was not updated'
+    assert store.update(str(uuid4()), title='C') is None, \
+        'nonexistent book was updated'
+
+    assert store.delete(book['id']) == updated, 'wrong deleted book'
+    assert store.get(book['id']) is None, 'book was not deleted'
+    assert store.delete(book['id']) is None, 'book was deleted twice'
+    assert len(store) == 0, 'wrong number of books'
+
+
+def test_version_and_number_of_books(store):
+    """ Check that every change of books increases the version,
+        and requests which change nothing do not. """
+
+    version = store.version()
+    books = store.add_many(make_books(['A', 'B', 'C']))
+    assert store.version() > version, 'version was not increased'
+    assert len(store) == 3, 'wrong number of books'
+
+    version = store.version()
+    assert store.update_many([(str(uuid4()), 'D', None)]) == [None]
+    assert store.delete_many([str(uuid4())]) == [None]
+    assert store.version() == version, 'version of no changes was increased'
+
+    store.update_many([(books[0]['id'], 'D', None)])
+    assert store.version() > version, 'version was not increased'
+
+    version = store.version()
+    store.delete_many([books[0]['id'], books[1]['id'], str(uuid4())])
+    assert store.version() > version, 'version was not increased'
+    assert len(store) == 1, 'wrong number of books'
+
+
+@pytest.mark.parametrize('sort', [None, 'by_title'])
+def test_page_of_books(store, sort):
+    """ Check order of books, start, limit and fields of the page. """
+
+    books = store.add_many(make_books(['C', 'A', 'B', 'A']))
+    expected = books
+    if sort == 'by_title':
+        # Books with the same title keep insertion order:
+        expected = sorted(books, key=lambda book: book['title'])
+
+    assert store.page(sort) == expected, 'wrong order of books'
+    assert store.page(sort, 1, 2) == expected[1:3], 'wrong page'
+    assert store.page(sort, 3, 5) == expected[3:], 'wrong last page'
+    assert store.page(sort, fields=['title']) == \
+        [{'title': book['title']} for book in expected], 'wrong fields'
+    assert list(store.iter_page(sort, 1, fields=['id'])) == \
+        [{'id': book['id']} for book in expected[1:]], 'wrong iterated page'
+
+
+@pytest.mark.parametrize('sort', [None, 'by_title'])
+def test_page_after_deleted_book(store, sort):
+    """ Check that the page after the key of a book starts right
+        after it, even if the book was deleted. """
+
+    store.add_many(make_books(['C', 'A', 'B', 'A', 'D']))
+
+    first, keys = store.page_with_keys(sort, 0, 2)
+    rest = store.page(sort, 2)
+    assert len(keys) == 2, 'wrong number of keys'
+    assert store.page(sort, after=keys[-1]) == rest, 'wrong next page'
+
+    store.delete(first[-1]['id'])
+    assert store.page(sort, after=keys[-1]) == rest, \
+        'wrong page after deleted book'
+    assert store.page(sort, 1, 1, after=keys[-1]) == rest[1:2], \
+        'wrong offset after deleted book'
+
+
+@pytest.mark.parametrize('sort', [None, 'by_title'])
+def test_page_with_filters(store, sort):
+    """ Check that filters by author and title prefix select the same
+        books as filters of the full list. """
+
+    books = store.add_many(
+        make_books(['Ab', 'B', 'Aa', 'A'], author='Pushkin') +
+        make_books(['Ac', 'Ab'], author='Tolstoy'))
+
+    def expected(author=None, prefix=''):
+        result = [book for book in store.page(sort)
+                  if author in (None, book['author']) and
+                  book['title'].startswith(prefix)]
+        assert result, 'nothing to check'
+        return result
+
+    assert store.page(sort, author='Tolstoy') == expected('Tolstoy')
+    assert store.page(sort, title_prefix='A') == expected(prefix='A')
+    assert store.page(sort, author='Pushkin', title_prefix='A') == \
+        expected('Pushkin', 'A')
+    assert store.page(sort, 1, 1, author='Pushkin', title_prefix='A') == \
+        expected('Pushkin', 'A')[1:2], 'wrong page of filtered books'
+    assert store.page(sort, author=str(uuid4())) == [], \
+        'books of other author are found'
+
+    # Books are found by the new title and author after update:
+    book = books[1]
+    store.update(book['id'], title='Ax', author='Tolstoy')
+    assert store.page(sort, author='Tolstoy', title_prefix='Ax') == \
+        [dict(book, title='Ax', author='Tolstoy')], 'updated book not found'
+
+
+def test_search_books(store):
+    """ Check that books are found by words of title and author,
+        and the best matches go first. """
+
+    books = store.add_many([
+        {'id': str(uuid4()), 'title': 'War and Peace', 'author': 'Tolstoy'},
+        {'id': str(uuid4()), 'title': 'Peace, peace', 'author': 'Smith'},
+        {'id': str(uuid4()), 'title': 'The War', 'author': 'Peace'}])
+
+    assert store.search('war') == [books[0], books[2]], 'wrong books found'
+    assert store.search('peace')[0] == books[1], 'wrong best match'
+    assert store.search('war tolstoy') == [books[0]], 'wrong books found'
+    assert store.search('war', 1, 1) == [books[2]], 'wrong page found'
+    assert store.search('dickens') == [], 'unknown word was found'
+
+    store.update(books[0]['id'], title='Anna Karenina')
+    store.delete(books[2]['id'])
+    assert store.search('war') == [], 'old title was found'
+    assert store.search('karenina') == [dict(books[0],
+                                             title='Anna Karenina')]
+
+
+def test_sqlite_store_matches_book_store(tmp_path):
+    """ Check that SQLite store returns the same books in the same
+        order as the store in memory. """
+
+    rand = random.Random(1)
+    titles = [''.join(rand.choice('aAbé Ж😀') for _ in range(3))
+              for _ in range(200)]
+    authors = ['Pushkin', 'Tolstoy', 'Gogol']
+
+    books = [{'id': str(uuid4()), 'title': title,
+              'author': rand.choice(authors)} for title in titles]
+    stores = [open_store('memory', tmp_path), open_store('sqlite', tmp_path)]
+
+    for store in stores:
+        store.add_many(books)
+        store.delete_many([book['id'] for book in books[::7]])
+
+    for sort in (None, 'by_title'):
+        for author in (None, 'Gogol'):
+            for prefix in (None, 'a', 'é', 'Ж😀'):
+                pages = [store.page(sort, 5, 50, author=author,
+                                    title_prefix=prefix)
+                         for store in stores]
+                assert pages[0] == pages[1], 'pages are different'
+
+    for query in ('a', 'ab', 'Ж', 'tolstoy'):
+        assert stores[0].search(query) == stores[1].search(query), \
+            'results of search are different'
+
+    for store in stores:
+        store.close()
+
+
+def test_sqlite_store_is_reopened(tmp_path):
+    """ Check that SQLite store keeps books, their number, version
+        and epoch after it is opened again. """
+
+    store = open_store('sqlite', tmp_path)
+    books = store.add_many(make_books(['A', 'B', 'C']))
+    store.delete(books[0]['id'])
+    version = store.version()
+    epoch = store.epoch
+    store.close()
+
+    store = open_store('sqlite', tmp_path)
+    assert store.page() == books[1:], 'books were not kept'
+    assert len(store) == 2, 'number of books was not kept'
+    assert store.version() == version, 'version was not kept'
+    assert store.epoch == epoch, 'epoch was changed'
+    assert store.search('b') == [books[1]], 'tokens were not kept'
+
+    # Databases created before the number of books was kept
+    # in meta get it counted when they are opened:
+    store.db.conn().execute("DELETE FROM meta WHERE key = 'count'")
+    store.close()
+
+    store = open_store('sqlite', tmp_path)
+    assert len(store) == 2, 'number of books was not counted'
+    store.close()
+
+
+def test_sqlite_connection_is_closed_with_thread(tmp_path):
+    """ Check that connection of the thread is closed when
+        the thread ends. """
+
+    store = open_store('sqlite', tmp_path)
+    store.add_many(make_books(['A']))
+
+    connections = []
+
+    def read():
+        store.page()
+        connections.append(store.db.conn())
+
+    for _ in range(5):
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+
+    for conn in connections:
+        with pytest.raises(Exception, match='closed'):
+            conn.execute('SELECT 1')
+
+    # Connection of current thread is still open:
+    assert len(store) == 1, 'connection of current thread was closed'
+    store.close()
@@ -1,9 +1,16 @@
 #!/usr/bin/python3
 # -*- encoding=utf8 -*-
 
+import asyncio
+import base64
+import json
+import logging
 import pytest
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
 
 from tests.utils import *
+from tests.async_utils import AsyncClient
 
 
 def test_login():
@@ -46,6 +53,51 @@ def test_wrong_credentials():
     assert data == 401, 'status code is not 401'
 
 
+def test_login_again_with_rejected_cookie():
+    """ This test checks that helpers log in again if the service
+        rejects cached auth cookie. """
+
+    # Put invalid cookie to the cache:
+    cookies = {'my_cookie': str(uuid4())}
+    tokens._cookies = cookies
+
+    book = add_book({'title': 'TeSt', 'author': 'Pushkin'})
+
+    # Verify that the book was added with new cookie:
+    assert validate_uuid4(book['id']), 'book was not added'
+    assert tokens.cookies() != cookies, 'cookie was not changed'
+
+    # Verify that every request logs in when the cache is disabled:
+    with tokens.disabled():
+        assert tokens.cookies() != tokens.cookies(), 'cookie was cached'
+
+
+def test_login_with_hashed_password(local_service):
+    """ This test checks login of user with hashed password in config
+        and that verified credentials are cached. """
+
+    # The module of the service is importable when it runs in tests:
+    from auth import hash_password
+
+    module = local_service.module
+    config = module.app.config
+    config['BASIC_AUTH_USERS'] = {
+        'reader': hash_password('secret', iterations=1000)}
+    try:
+        url = '{0}/login'.format(host)
+        result = get(url, auth_data=HTTPBasicAuth('reader', 'qwe'))
+        assert result.status_code == 401, 'wrong password is accepted'
+
+        hits = module.basic_auth.stats()['hits']
+        for _ in range(2):
+            result = get(url, auth_data=HTTPBasicAuth('reader', 'secret'))
+            assert result.status_code == 200, 'valid password is rejected'
+        assert module.basic_auth.stats()['hits'] == hits + 1, \
+            'verified credentials are not cached'
+    finally:
+        config['BASIC_AUTH_USERS'] = {}
+
+
 def test_get_list_of_books():
     """ Check that 'get books' method returns correct list of books. """
 
@@ -242,6 +294,293 @@ def test_get_sorted_and_limited_list_of_books():
     assert len(all_books) == 2, 'list of books not limited'
 
 
+def test_sorted_list_keeps_order_of_same_titles():
+    """ Check that 'get books' method sorts books with the same title
+        in the order they were added. """
+
+    # Create three books with the same unique title:
+    title = str(uuid4())
+    books = [add_book({'title': title, 'author': str(i)}) for i in range(3)]
+
+    # Move the first book to the end of the sorted list and back:
+    update_book(books[0]['id'], {'title': title + 'z'})
+    update_book(books[0]['id'], {'title': title})
+
+    # Get sorted list of all books:
+    all_books = get_all_books(filters={'sort': 'by_title'})
+    same_title = [book for book in all_books if book['title'] == title]
+
+    # Make sure that books with the same title keep insertion order:
+    assert same_title == books, 'wrong order of books with the same title'
+
+
+@pytest.mark.parametrize('sort', ['', 'by_title'])
+def test_get_list_of_books_by_pages(sort):
+    """ Check that 'get books' method returns all books page by page. """
+
+    # Create three books, just to make sure books will be correctly
+    # added to the list:
+    add_three_books()
+
+    # Get list of all books:
+    all_books = get_all_books(filters={'sort': sort})
+
+    # Get the same list page by page:
+    books = []
+    filters = {'sort': sort, 'limit': 50, 'cursor': ''}
+    while filters['cursor'] is not None:
+        page = get_all_books(filters=filters)
+        assert len(page['books']) <= 50, 'page of books not limited'
+
+        books.extend(page['books'])
+        filters['cursor'] = page['next_cursor']
+
+    # Make sure that pages contain all books in the same order:
+    assert books == all_books, 'pages do not match list of books'
+
+
+def test_get_list_of_books_with_offset():
+    """ Check that 'get books' method skips books on offset param. """
+
+    # Create three books, just to make sure books will be correctly
+    # added to the list:
+    add_three_books()
+
+    # Get list of all books:
+    all_books = get_all_books()
+
+    # Get two books starting from the second one:
+    books = get_all_books(filters={'offset': 1, 'limit': 2})
+
+    # Make sure that the first book was skipped:
+    assert books == all_books[1:3], 'wrong books on offset'
+
+
+def test_get_list_of_books_with_fields():
+    """ Check that 'get books' method returns only requested fields. """
+
+    # Create three books, just to make sure books will be correctly
+    # added to the list:
+    add_three_books()
+
+    all_books = get_all_books()
+    books = get_all_books(filters={'fields': 'author,id'})
+
+    # Make sure that books have only id and author:
+    expected = [{'id': book['id'], 'author': book['author']}
+                for book in all_books]
+    assert books == expected, 'wrong fields of books'
+
+    # Make sure that unknown fields are not allowed:
+    result = get_all_books(filters={'fields': 'id,price'})
+    assert result == {'message': 'Invalid fields!'}, 'wrong message'
+
+
+@pytest.mark.parametrize('sort', ['', 'by_title'])
+def test_get_list_of_books_by_author_and_title_prefix(sort):
+    """ Check that 'get books' method returns only books of given
+        author and with given title prefix, page by page. """
+
+    # Create books with unique author:
+    author = u'Пушкин ' + str(uuid4())
+    titles = [u'тест 2', u'тест 1', 'TeSt', u'тест', u'тес', 'test']
+    books = add_books([{'title': title, 'author': author}
+                       for title in titles])
+    add_book({'title': u'тест 3', 'author': 'Pushkin'})
+
+    if sort == 'by_title':
+        books = sorted(books, key=lambda book: book['title'])
+
+    # Make sure that all books of the author are found:
+    result = get_all_books(filters={'sort': sort, 'author': author})
+    assert result == books, 'wrong books of the author'
+
+    # Make sure that only books with the prefix are found:
+    result = get_all_books(filters={'sort': sort, 'author': author,
+                                    'title_prefix': u'тест'})
+    assert result == [book for book in books
+                      if book['title'].startswith(u'тест')], 'wrong books'
+
+    # Make sure that pages contain the same books:
+    pages = []
+    filters = {'sort': sort, 'author': author, 'limit': 2, 'cursor': ''}
+    while filters['cursor'] is not None:
+        page = get_all_books(filters=filters)
+        pages.extend(page['books'])
+        filters['cursor'] = page['next_cursor']
+
+    assert pages == books, 'pages do not match list of books'
+
+
+@pytest.mark.parametrize('sort', ['', 'by_title'])
+def test_get_next_page_when_last_book_is_deleted(local_service,
+                                                  monkeypatch, sort):
+    """ Check that the cursor is created when the last book of the page
+        is deleted right after the page is read. """
+
+    author = str(uuid4())
+    books = add_books([{'title': title, 'author': author}
+                       for title in ('A', 'B', 'C')])
+
+    store = local_service.module.BOOKS
+    page_with_keys = store.page_with_keys
+
+    def page_and_delete(*args, **kwargs):
+        result, keys = page_with_keys(*args, **kwargs)
+        monkeypatch.undo()
+        store.delete(result[1]['id'])
+        return result, keys
+
+    monkeypatch.setattr(store, 'page_with_keys', page_and_delete)
+
+    filters = {'sort': sort, 'author': author, 'limit': 2, 'cursor': ''}
+    page = get_all_books(filters=filters)
+    assert page['books'] == books[:2], 'wrong first page'
+
+    filters['cursor'] = page['next_cursor']
+    page = get_all_books(filters=filters)
+    assert page['books'] == books[2:], 'wrong next page'
+
+
+@pytest.mark.parametrize('sort', ['', 'by_title'])
+def test_get_streamed_list_of_books(sort):
+    """ Check that 'get books' method streams the same list of books
+        as newline delimited JSON. """
+
+    # Create three books, just to make sure books will be correctly
+    # added to the list:
+    add_three_books()
+
+    # Get list of all books:
+    all_books = get_all_books(filters={'sort': sort})
+
+    # Get the same list as a stream:
+    url = '{0}/books'.format(host)
+    result = get(url, cookies=auth(), body={'sort': sort, 'stream': 1})
+    books = [json.loads(line) for line in result.text.splitlines()]
+
+    # Make sure that stream contains all books in the same order,
+    # and the list was not buffered to count its length:
+    assert result.headers['Content-Type'] == 'application/x-ndjson'
+    assert 'Content-Length' not in result.headers, 'list is not streamed'
+    assert books == all_books, 'stream does not match list of books'
+
+
+@pytest.mark.parametrize('path', ['/books', '/books/{0}'])
+def test_get_not_modified_books(path):
+    """ Check that 'get books' and 'get book' methods return 304 if
+        books were not changed since the last request. """
+
+    # Create new book:
+    book = add_book({'title': 'B', 'author': ''})
+
+    url = host + path.format(book['id'])
+    cookies = auth()
+
+    # Get books and their ETag:
+    result = get(url, cookies=cookies)
+    etag = result.headers['ETag']
+
+    # Make sure that the same version of books is not sent again:
+    result = get(url, cookies=cookies, headers={'If-None-Match': etag})
+    assert result.status_code == 304, 'status code is not 304'
+    assert result.headers['ETag'] == etag, 'ETag changed'
+
+    # Make sure that changed books are sent:
+    update_book(book['id'], {'title': 'A'})
+    result = get(url, cookies=cookies, headers={'If-None-Match': etag})
+    assert result.status_code == 200, 'status code is not 200'
+    assert result.headers['ETag'] != etag, 'ETag not changed'
+
+
+def test_search_books():
+    """ Check that 'search books' method finds books by words of
+        title and author, the best matches go first. """
+
+    # Create books with unique word:
+    word = uuid4().hex
+    books = add_books([
+        {'title': u'Тест ' + word, 'author': u'Пушкин'},
+        {'title': u'тест {0} {0}'.format(word), 'author': u'Пушкин'},
+        {'title': 'Test ' + word, 'author': 'Pushkin'}])
+
+    # Make sure that books are found by words in any case,
+    # and the book with two words goes first:
+    result = search_books(u'ТЕСТ пушкин ' + word)
+    assert result == [books[1], books[0]], 'wrong books found'
+
+    # Make sure that limit and offset select the page of results:
+    result = search_books(word, filters={'limit': 1, 'offset': 1})
+    assert result == [books[0]], 'wrong page of books'
+
+    # Make sure that changed and deleted books are found correctly:
+    update_book(books[2]['id'], {'title': 'Test', 'author': word})
+    delete_book(books[1]['id'])
+    result = search_books(word)
+    assert [book['id'] for book in result] == \
+        [books[0]['id'], books[2]['id']], 'index not updated'
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate'])
+def test_get_compressed_book(encoding):
+    """ Check that big responses are compressed if client accepts it. """
+
+    book = add_book({'title': 'a' * 100000, 'author': 'Pushkin'})
+    url = '{0}/books/{1}'.format(host, book['id'])
+
+    result = get(url, cookies=auth(), headers={'Accept-Encoding': encoding})
+
+    # Make sure that the book is compressed and not changed:
+    assert result.headers['Content-Encoding'] == encoding, 'not compressed'
+    assert int(result.headers['Content-Length']) < 100000, 'too big'
+    assert result.json() == book, 'wrong book'
+
+
+def test_get_books_in_msgpack():
+    """ Check that the book is the same in MessagePack and in JSON. """
+
+    pytest.importorskip('msgpack')
+
+    book = add_book({'title': u'тест', 'author': u'Пушкин'})
+    url = '{0}/books/{1}'.format(host, book['id'])
+
+    result = get(url, cookies=auth(), headers=format_headers('msgpack'))
+
+    # Make sure that the book is sent in MessagePack format:
+    assert result.headers['Content-Type'] == MSGPACK, 'wrong format'
+    assert parse(result) == book, 'wrong book'
+
+
+def test_get_list_of_books_with_invalid_cursor():
+    """ Check that 'get books' method returns error on invalid cursor. """
+
+    result = get_all_books(filters={'cursor': 'qwe'})
+
+    # Make sure that there is correct error message
+    assert result == {'message': 'Invalid cursor!'}, 'wrong message'
+
+
+@pytest.mark.parametrize('values', [{'title': 5}, {'title': ['A']},
+                                    {'seq': 'A'}, {'seq': 1.5},
+                                    {'seq': 2 ** 70}, {'id': ['A']},
+                                    {'offset': float('inf')},
+                                    {'offset': None}])
+def test_get_list_of_books_with_hand_made_cursor(values):
+    """ Check that 'get books' method returns error on cursor
+        with values of wrong type. """
+
+    data = {'sort': 'by_title', 'filters': {}, 'id': str(uuid4()),
+            'seq': 1, 'offset': 0, 'title': 'A'}
+    data.update(values)
+    cursor = base64.urlsafe_b64encode(json.dumps(data).encode('utf8'))
+
+    result = get_all_books(filters={'sort': 'by_title',
+                                    'cursor': cursor.decode('ascii')})
+
+    # Make sure that there is correct error message
+    assert result == {'message': 'Invalid cursor!'}, 'wrong message'
+
+
 def test_similar_id_in_list():
     """ Check that there are no similar id in list of books. """
 
@@ -304,6 +643,66 @@ def test_add_several_new_books():
     assert len(all_books) >= 3, 'less than 3 books in the list'
 
 
+def test_add_several_books_with_one_request():
+    """ Check 'create books' method for several books and invalid ones. """
+
+    # Create two books and one invalid book with one request:
+    books = [{'title': 'B', 'author': ''}, {'title': 1}, {'author': 'Pushkin'}]
+    new_books = add_books(books)
+
+    # Get list of all books
+    all_books = get_all_books()
+
+    # Verify that valid books were added with default values:
+    assert new_books[1] == {'message': 'Invalid book!'}, 'wrong message'
+    assert new_books[0]['title'] == 'B', 'no title of the book'
+    assert new_books[2]['author'] == 'Pushkin', 'no book author'
+    assert new_books[2]['title'] == '', 'title of added book not empty'
+    for book in (new_books[0], new_books[2]):
+        assert validate_uuid4(book['id']), 'invalid book id'
+        assert book in all_books, 'new book not in list of the books'
+
+
+def test_update_several_books_with_one_request():
+    """ Check 'update books' method for several books. """
+
+    # Create new books for update:
+    first_book, second_book = add_books([{'title': '', 'author': ''}] * 2)
+
+    # Update both books and nonexistent one:
+    result = update_books([{'id': first_book['id'], 'title': 'Qwerty'},
+                           {'id': 'qwe', 'title': 'Qwerty'},
+                           {'id': second_book['id'], 'author': 'Pushkin'}])
+
+    # Verify that changes were applied correctly:
+    assert get_book(first_book['id'])['title'] == 'Qwerty'
+    assert get_book(second_book['id'])['author'] == 'Pushkin'
+    assert result == [get_book(first_book['id']),
+                      {'id': 'qwe', 'message': 'No book with given ID!'},
+                      get_book(second_book['id'])], 'wrong result of update'
+
+
+def test_delete_several_books_with_one_request():
+    """ Check 'delete books' method for several books. """
+
+    # Create new books for delete and one more book:
+    books = add_books([{'title': '1', 'author': '2'}] * 3)
+
+    # Delete two books and nonexistent one:
+    result = delete_books([books[0]['id'], {'id': books[1]['id']}, 'qwe'])
+
+    # Get list of all books
+    all_books = get_all_books()
+
+    # Verify that books are not presented in the list:
+    assert result == [{'deleted': books[0]['id']},
+                      {'deleted': books[1]['id']},
+                      {'deleted': 'qwe'}], 'not returned deleted book ids'
+    assert books[0] not in all_books, 'added book not deleted'
+    assert books[1] not in all_books, 'added book not deleted'
+    assert books[2] in all_books, 'added book not in list'
+
+
 def test_add_book_with_empty_title():
     """ Check 'create book' method with empty title. """
 
@@ -498,35 +897,207 @@ def test_full_cycle_of_the_book(title, author):
     assert book not in all_books, 'added book not deleted'
 
 
+@pytest.mark.usefixtures('clean_service')
+def test_parallel_changes_of_books():
+    """ Check that no changes are lost when books are added, updated
+        and deleted by many clients at the same time. """
+
+    title = str(uuid4())
+
+    # Add books from many threads at the same time:
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        books = list(pool.map(
+            lambda i: add_book({'title': title, 'author': str(i)}),
+            range(200)))
+
+    # Update half of books and delete the other half in parallel:
+    def change(book):
+        if int(book['author']) % 2:
+            return delete_book(book['id'])
+        return update_book(book['id'], {'author': 'Pushkin'})
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(change, books))
+
+    # Get list of all books
+    all_books = get_all_books()
+    same_title = [book for book in all_books if book['title'] == title]
+
+    # Verify that every change was applied:
+    assert len(set(book['id'] for book in books)) == 200, 'similar id'
+    assert len(same_title) == 100, 'some books were lost or not deleted'
+    for book in same_title:
+        assert book['author'] == 'Pushkin', 'update of the book was lost'
+
+
+def test_full_cycle_of_books_with_async_client():
+    """ Check that books are added, updated and deleted by parallel
+        requests of async client. """
+
+    async def full_cycle():
+        async with AsyncClient(concurrency=8) as client:
+            books = await client.add_many(
+                [{'title': u'тест', 'author': str(i)} for i in range(20)])
+            book_ids = [book['id'] for book in books]
+
+            found = await client.get_many(book_ids)
+            assert found == books, 'wrong books found'
+
+            await client.update_many((book_id, {'author': 'Pushkin'})
+                                     for book_id in book_ids)
+            updated = await client.get_many(book_ids)
+            assert all(book['author'] == 'Pushkin' for book in updated), \
+                'books were not updated'
+
+            await client.delete_many(book_ids)
+            deleted = await client.get_many(book_ids)
+            assert deleted == [{}] * len(book_ids), 'books were not deleted'
+
+    asyncio.run(full_cycle())
+
+
 def test_validate_cookie():
     """ Check auth cookie validation. """
 
-    # Set name of host
-    host_name = 'http://0.0.0.0:7000'
     # Set right message of invalid cookie
     right_message = {"message": "No valid auth cookie provided!"}
 
-    url = '{0}/books'.format(host_name)
+    url = '{0}/books'.format(host)
     result = get(url)
     message = result.json()
     assert message == right_message, 'wrong message of invalid cookie'
 
-    url = '{0}/add_book'.format(host_name)
+    url = '{0}/add_book'.format(host)
     result = post(url)
     message = result.json()
     assert message == right_message, 'wrong message of invalid cookie'
 
-    url = '{0}/books/qwe'.format(host_name)
+    url = '{0}/books/qwe'.format(host)
     result = get(url)
     message = result.json()
     assert message == right_message, 'wrong message of invalid cookie'
 
-    url = '{0}/books/qwe'.format(host_name)
+    url = '{0}/books/qwe'.format(host)
     result = delete(url)
     message = result.json()
     assert message == right_message, 'wrong message of invalid cookie'
 
-    url = '{0}/books/qwe'.format(host_name)
+    url = '{0}/books/qwe'.format(host)
     result = put(url)
     message = result.json()
     assert message == right_message, 'wrong message of invalid cookie'
+
+
+def test_ready():
+    """ Check that the readiness probe answers without auth. """
+
+    result = get('{0}/ready'.format(host))
+
+    assert result.status_code == 200, 'service is not ready'
+    assert result.json() == {'status': 'ready'}, 'wrong status'
+
+
+def test_connection_is_kept_alive(local_service, caplog):
+    """ Check that the service keeps connections open, so requests
+        of the pooled client reuse them. """
+
+    if local_service.server is None:
+        pytest.skip('connections are checked only in local HTTP service')
+
+    url = '{0}/ready'.format(host)
+    get(url)
+
+    with caplog.at_level(logging.DEBUG, logger='urllib3.connectionpool'):
+        results = [get(url) for _ in range(3)]
+
+    assert all(result.headers['Connection'] == 'keep-alive'
+               for result in results), 'connection is closed'
+    assert not [record for record in caplog.records
+                if 'Starting new' in record.getMessage()], \
+        'new connection was opened'
+
+
+def test_get_metrics():
+    """ Check that requests and size of catalogue are in metrics. """
+
+    get_all_books()
+    url = '{0}/metrics'.format(host)
+    result = get(url)
+    assert result.status_code == 200, 'metrics are not available'
+
+    lines = result.text.splitlines()
+    counters = [line for line in lines
+                if line.startswith('books_http_requests_total{') and
+                'route="/books"' in line and 'status="200"' in line]
+    assert counters, 'requests to /books are not counted'
+    assert int(counters[0].split()[-1]) >= 1, 'wrong number of requests'
+
+    assert any(line.startswith('books_catalogue_size ') for line in lines), \
+        'size of catalogue is not in metrics'
+    assert any(line.startswith('books_http_request_duration_seconds_bucket')
+               for line in lines), 'latency of requests is not in metrics'
+
+
+def test_profile_request(local_service):
+    """ Check that request with profiling header is profiled. """
+
+    config = local_service.module.app.config
+    config['PROFILING_ENABLED'] = True
+    try:
+        url = '{0}/books'.format(host)
+        result = send_with_auth(get, url, headers={'X-Profile': '1'})
+        profile_id = result.headers.get('X-Profile-Id')
+        assert profile_id, 'request was not profiled'
+
+        url = '{0}/debug/profiles/{1}'.format(host, profile_id)
+        profile = get(url, auth_data=HTTPBasicAuth(valid_user,
+                                                valid_password)).json()
+        assert profile['path'] == '/books', 'wrong path of request'
+        assert profile['status'] == 200, 'wrong status of request'
+        assert profile['functions'], 'calls of functions are not profiled'
+        assert 'memory' in profile, 'memory is not profiled'
+    finally:
+        config['PROFILING_ENABLED'] = False
+
+
+def test_rate_limit(local_service, monkeypatch):
+    """ Check that client gets 429 when it sends too many requests. """
+
+    # Limits are read from config on every request, and new limiter
+    # has no buckets of other tests:
+    module = local_service.module
+    monkeypatch.setattr(module, 'RATE_LIMITER', module.RateLimiter())
+    monkeypatch.setitem(module.app.config, 'RATE_LIMITS',
+                        {'/books/<book_id>': (0.01, 2)})
+    monkeypatch.setitem(module.app.config, 'RATE_LIMIT_ENABLED', True)
+
+    url = '{0}/books/qwe'.format(host)
+    with client.retries_disabled():
+        results = [send_with_auth(get, url) for _ in range(3)]
+
+    assert [result.status_code for result in results] == \
+        [200, 200, 429], 'requests over the limit are not rejected'
+    assert int(results[-1].headers['Retry-After']) > 0, \
+        'wrong Retry-After header'
+
+
+def test_concurrency_limit(local_service, monkeypatch):
+    """ Check that requests over the limit of concurrent requests
+        get 503. """
+
+    # The limit works without rate limits:
+    module = local_service.module
+    monkeypatch.setattr(module, 'CONCURRENCY', module.ConcurrencyLimiter())
+    monkeypatch.setitem(module.app.config, 'MAX_CONCURRENT_REQUESTS', 1)
+
+    url = '{0}/books/qwe'.format(host)
+    assert send_with_auth(get, url).status_code == 200, \
+        'request under the limit is rejected'
+
+    # Take the only place, as if another request is in progress:
+    assert module.CONCURRENCY.acquire(1)
+    with client.retries_disabled():
+        result = send_with_auth(get, url)
+    assert result.status_code == 503, 'request over the limit is admitted'
+    assert result.headers['Retry-After'] == '1', \
+        'wrong Retry-After header'
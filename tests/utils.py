@@ -1,12 +1,26 @@
 #!/usr/bin/python3
 # -*- encoding=utf8 -*-
 
+import io
+import logging
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3 import HTTPResponse
+from urllib3.util.retry import Retry
+from werkzeug.test import EnvironBuilder, run_wsgi_app
 from configparser import ConfigParser
+from contextlib import contextmanager
 from uuid import UUID
 import random
 import itertools
+import threading
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 config = ConfigParser()
@@ -14,7 +28,7 @@ config.read('test_config.conf')
 
 
 def get_conf_param(section, parameter, default_value):
-    result = config.get(section, parameter)
+    result = config.get(section, parameter, fallback=None)
     return result or default_value
 
 
@@ -22,6 +36,188 @@ def get_conf_param(section, parameter, default_value):
 valid_user = get_conf_param('DEFAULT', 'user', '')
 valid_password = get_conf_param('DEFAULT', 'password', '')
 host = get_conf_param('DEFAULT', 'host', 'http://0.0.0.0:7000')
+# Format of responses for helpers below: 'json' or 'msgpack':
+response_format = get_conf_param('DEFAULT', 'format', 'json')
+
+# Connections to the service kept open, retries of failed connections
+# and timeouts (in seconds) of all requests:
+pool_size = int(get_conf_param('DEFAULT', 'pool_size', 16))
+retries = int(get_conf_param('DEFAULT', 'retries', 3))
+connect_timeout = float(get_conf_param('DEFAULT', 'connect_timeout', 5))
+read_timeout = float(get_conf_param('DEFAULT', 'read_timeout', 60))
+# Every request is logged with INFO level, and bodies of requests and
+# responses (no more than log_body_limit characters) with DEBUG level:
+log_level = get_conf_param('DEFAULT', 'log_level', 'INFO').upper()
+log_body_limit = int(get_conf_param('DEFAULT', 'log_body_limit', 1000))
+# Helpers log in once and reuse auth cookie if it is 'yes':
+token_cache = get_conf_param('DEFAULT', 'token_cache', 'yes') == 'yes'
+# Every process of tests starts its own instance of the service
+# on a free port if it is 'yes', otherwise tests use `host`:
+start_service = get_conf_param('DEFAULT', 'start_service', 'no') == 'yes'
+# How the started service gets requests: 'http' - through a socket,
+# 'wsgi' - by direct calls of the application in the same thread:
+transport = get_conf_param('DEFAULT', 'transport', 'http')
+# Where the started service keeps books and sessions: 'memory' or
+# 'sqlite' (a new database in a temporary directory):
+storage = get_conf_param('DEFAULT', 'storage', 'memory')
+
+MSGPACK = 'application/msgpack'
+
+log = logging.getLogger('tests.requests')
+log.setLevel(log_level)
+NO_AUTH_MESSAGE = 'No valid auth cookie provided!'
+
+
+def shorten(data, limit=None):
+    """ This function returns text or bytes cut to `limit`
+        characters, with the number of characters cut.
+    """
+
+    limit = log_body_limit if limit is None else limit
+
+    if isinstance(data, bytes):
+        text = data[:limit].decode('utf8', errors='replace')
+    else:
+        text = data[:limit]
+
+    if len(data) > limit:
+        text += '... ({0} more)'.format(len(data) - limit)
+
+    return text
+
+
+def log_response(response, latency):
+    """ This function logs method, url, status, latency and size
+        of the request, and its body and response body on DEBUG.
+    """
+
+    if not log.isEnabledFor(logging.INFO):
+        return
+
+    request = response.request
+    record = {'method': request.method,
+              'url': shorten(request.url, 200),
+              'status': response.status_code,
+              'latency': round(latency * 1000, 3),
+              'size': len(response.content)}
+
+    log.info('%(method)s %(url)s -> %(status)s, %(size)s bytes '
+             'in %(latency)s ms', record, extra=record)
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Request body: %s', shorten(request.body or b''),
+                  extra=record)
+        log.debug('Response body: %s', shorten(response.content),
+                  extra=record)
+
+
+class WSGIAdapter(HTTPAdapter):
+    """ This class is a transport of requests.Session which passes
+        requests directly to WSGI application, without sockets.
+
+        Responses are built the same way as for HTTP, so helpers get
+        the same requests.Response, and compressed bodies are decoded.
+    """
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def send(self, request, **kwargs):
+        builder = EnvironBuilder(path=request.url, method=request.method,
+                                 headers=dict(request.headers),
+                                 data=request.body or b'')
+        try:
+            environ = builder.get_environ()
+        finally:
+            builder.close()
+
+        app_iter, status, headers = run_wsgi_app(self.app, environ,
+                                                 buffered=True)
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        code, _, reason = status.partition(' ')
+        raw = HTTPResponse(body=io.BytesIO(body), headers=list(headers),
+                           status=int(code), reason=reason,
+                           preload_content=False, decode_content=True)
+
+        return self.build_response(request, raw)
+
+
+class Client(object):
+    """ This class sends requests to the service through one
+        requests.Session, so connections are kept alive and reused
+        by all helpers and threads.
+
+        Every request has a timeout and is written to the log. Requests
+        which could not connect are retried, and GET, PUT and DELETE are
+        also retried if the connection was broken while waiting for the
+        response, or after Retry-After of 429 and 503 responses.
+
+        With `mount_wsgi()` requests to the service are passed to the
+        WSGI application in the same process instead.
+    """
+
+    def __init__(self, pool_size=10, retries=3, timeout=(5, 60)):
+        self.timeout = timeout
+
+        retry = Retry(total=retries, backoff_factor=0.1,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        """ This function sends request with default timeout. """
+
+        kwargs.setdefault('timeout', self.timeout)
+
+        started = time.perf_counter()
+        response = self.session.request(method, url, **kwargs)
+        log_response(response, time.perf_counter() - started)
+
+        return response
+
+    def mount_wsgi(self, url, app):
+        """ This function sends all requests to the url
+            directly to WSGI application.
+        """
+
+        self.session.mount(url, WSGIAdapter(app))
+
+    @contextmanager
+    def retries_disabled(self):
+        """ This context manager sends requests without retries,
+            so tests see 429 and 503 responses instead of waiting
+            for Retry-After and sending the request again.
+        """
+
+        adapters = list(self.session.adapters.values())
+        saved = [adapter.max_retries for adapter in adapters]
+
+        for adapter in adapters:
+            adapter.max_retries = Retry(total=0, raise_on_status=False)
+        try:
+            yield
+        finally:
+            for adapter, max_retries in zip(adapters, saved):
+                adapter.max_retries = max_retries
+
+    def close(self):
+        """ This function closes all connections. """
+
+        self.session.close()
+
+
+client = Client(pool_size=pool_size, retries=retries,
+                timeout=(connect_timeout, read_timeout))
 
 
 def validate_uuid4(uuid_string):
@@ -35,58 +231,68 @@ def validate_uuid4(uuid_string):
     return val.hex == uuid_string.replace('-', '')
 
 
-def get(url,  body=None, cookies=None, auth_data=None):
-    """ This function sends REST API GET request and prints some
-        useful information for debugging.
+def format_headers(fmt=None):
+    """ This function returns headers which ask the service
+        for responses in given format.
     """
 
-    result = requests.get(url, cookies=cookies, params=body, auth=auth_data)
+    if (fmt or response_format) == 'msgpack':
+        return {'Accept': MSGPACK}
 
-    print('GET request to {0}'.format(url))
-    print('Status code: {0}'.format(result.status_code))
-    print('RESPONSE: {0}'.format(result.text))
-
-    return result
+    return {'Accept': 'application/json'}
 
 
-def post(url, cookies=None, body=None):
-    """ This function sends REST API POST request and prints some
-        useful information for debugging.
+def parse(response):
+    """ This function returns the data from the body of response
+        in JSON or MessagePack format.
     """
 
-    result = requests.post(url, cookies=cookies, data=body)
+    if response.headers.get('Content-Type', '').startswith(MSGPACK):
+        return msgpack.unpackb(response.content, raw=False)
+
+    return response.json()
+
+
+def get(url,  body=None, cookies=None, auth_data=None, headers=None):
+    """ This function sends REST API GET request, which is written
+        to the log for debugging.
+    """
 
-    print('POST request to {0}'.format(url))
-    print('Status code: {0}'.format(result.status_code))
-    print('RESPONSE: {0}'.format(result.text))
+    result = client.request('GET', url, cookies=cookies, params=body,
+                            auth=auth_data, headers=headers)
 
     return result
 
 
-def put(url, cookies=None, body=None):
-    """ This function sends REST API PUT request and prints some
-        useful information for debugging.
+def post(url, cookies=None, body=None, json_body=None, headers=None):
+    """ This function sends REST API POST request, which is written
+        to the log for debugging.
     """
 
-    result = requests.put(url, cookies=cookies, data=body)
-
-    print('PUT request to {0}'.format(url))
-    print('Status code: {0}'.format(result.status_code))
-    print('RESPONSE: {0}'.format(result.text))
+    result = client.request('POST', url, cookies=cookies, data=body,
+                            json=json_body, headers=headers)
 
     return result
 
 
-def delete(url, cookies=None):
-    """ This function sends REST API DELETE request and prints some
-        useful information for debugging.
+def put(url, cookies=None, body=None, json_body=None, headers=None):
+    """ This function sends REST API PUT request, which is written
+        to the log for debugging.
     """
 
-    result = requests.delete(url, cookies=cookies)
+    result = client.request('PUT', url, cookies=cookies, data=body,
+                            json=json_body, headers=headers)
+
+    return result
 
-    print('DELETE request to {0}'.format(url))
-    print('Status code: {0}'.format(result.status_code))
-    print('RESPONSE: {0}'.format(result.text))
+
+def delete(url, cookies=None, json_body=None, headers=None):
+    """ This function sends REST API DELETE request, which is written
+        to the log for debugging.
+    """
+
+    result = client.request('DELETE', url, cookies=cookies,
+                            json=json_body, headers=headers)
 
     return result
 
@@ -109,57 +315,187 @@ def auth(user=valid_user, password=valid_password):
         return response.status_code
 
 
+class TokenCache(object):
+    """ This class keeps one auth cookie for all helpers of the
+        process, so they do not log in before every request.
+
+        The cookie is dropped when the service rejects it, and the
+        next request logs in again. Tests of login can turn the cache
+        off with `disabled()`, then every request logs in.
+    """
+
+    def __init__(self, login, enabled=True):
+        self.enabled = enabled
+
+        self._login = login
+        self._cookies = None
+        self._lock = threading.Lock()
+
+    def cookies(self):
+        """ This function returns cached auth cookie or logs in. """
+
+        if not self.enabled:
+            return self._login()
+
+        with self._lock:
+            if self._cookies is None:
+                self._cookies = self._login()
+
+            return self._cookies
+
+    def invalidate(self, cookies):
+        """ This function drops the cookie rejected by the service,
+            unless another thread has already got a new one.
+        """
+
+        with self._lock:
+            if self._cookies == cookies:
+                self._cookies = None
+
+    def clear(self):
+        """ This function drops cached cookie. """
+
+        with self._lock:
+            self._cookies = None
+
+    @contextmanager
+    def disabled(self):
+        """ This context manager turns the cache off. """
+
+        enabled = self.enabled
+        self.enabled = False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+
+
+tokens = TokenCache(auth, enabled=token_cache)
+
+
+def is_rejected(response):
+    """ This function checks if the service rejected auth cookie. """
+
+    content_type = response.headers.get('Content-Type', '')
+    if response.status_code != 400 or \
+            not content_type.startswith('application/json'):
+        return False
+
+    return response.json() == {'message': NO_AUTH_MESSAGE}
+
+
+def send_with_auth(send, url, **kwargs):
+    """ This function sends request with auth cookie from the cache
+        and logs in again once if the cookie is not valid anymore.
+    """
+
+    cookies = tokens.cookies()
+    response = send(url, cookies=cookies, **kwargs)
+
+    if is_rejected(response):
+        tokens.invalidate(cookies)
+        response = send(url, cookies=tokens.cookies(), **kwargs)
+
+    return response
+
+
 def get_all_books(filters=None):
     """ This function returns full list of books. """
-    print(auth())
+
     url = '{0}/books'.format(host)
-    response = get(url, cookies=auth(), body=filters)
+    response = send_with_auth(get, url, body=filters,
+                              headers=format_headers())
 
-    return response.json()
+    return parse(response)
+
+
+def search_books(query, filters=None):
+    """ This function returns books found by words of the query. """
+
+    url = '{0}/books/search'.format(host)
+    params = dict(filters or {}, q=query)
+    response = send_with_auth(get, url, body=params,
+                              headers=format_headers())
+
+    return parse(response)
 
 
 def get_book(book_id='1'):
     """ This function returns one book. """
 
     url = '{0}/books/{1}'.format(host, book_id)
-    response = get(url, cookies=auth())
+    response = send_with_auth(get, url, headers=format_headers())
 
-    return response.json()
+    return parse(response)
 
 
 def add_book(book):
     """ This function creates new book. """
 
     url = '{0}/add_book'.format(host)
-    response = post(url, cookies=auth(), body=book)
+    response = send_with_auth(post, url, body=book,
+                              headers=format_headers())
 
-    return response.json()
+    return parse(response)
+
+
+def add_books(books):
+    """ This function creates several new books with one request. """
+
+    url = '{0}/add_books'.format(host)
+    response = send_with_auth(post, url, json_body=books,
+                              headers=format_headers())
+
+    return parse(response)
 
 
 def add_three_books():
     """ This function creates new three books. """
 
     # Create three books
-    add_book({'title': 'B', 'author': ''})
-    add_book({'title': '1', 'author': 'Pushkin'})
-    add_book({'title': 'A', 'author': '#$%$^'})
+    return add_books([{'title': 'B', 'author': ''},
+                      {'title': '1', 'author': 'Pushkin'},
+                      {'title': 'A', 'author': '#$%$^'}])
 
 
 def delete_book(book_id):
     """ This function deletes the book. """
 
     url = '{0}/books/{1}'.format(host, book_id)
-    response = delete(url, cookies=auth())
+    response = send_with_auth(delete, url, headers=format_headers())
 
-    return response.json()
+    return parse(response)
+
+
+def delete_books(book_ids):
+    """ This function deletes several books with one request. """
+
+    url = '{0}/books'.format(host)
+    response = send_with_auth(delete, url, json_body=book_ids,
+                              headers=format_headers())
+
+    return parse(response)
 
 
 def update_book(book_id, book):
     """ This function updates information about the book. """
 
     url = '{0}/books/{1}'.format(host, book_id)
-    response = put(url, cookies=auth(), body=book)
+    response = send_with_auth(put, url, body=book,
+                              headers=format_headers())
 
-    return response.json()
+    return parse(response)
+
+
+def update_books(books):
+    """ This function updates information about several books
+        with one request.
+    """
+
+    url = '{0}/books'.format(host)
+    response = send_with_auth(put, url, json_body=books,
+                              headers=format_headers())
+
+    return parse(response)
 
 